@@ -0,0 +1,316 @@
+# =====================================================
+# STOCKFLOW BATCH - KIEM TRA NHIEU PHIEU XUAT KHO SONG SONG
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import concurrent.futures
+import datetime
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from stockflow_engine import (
+    COL_OK,
+    DETAIL_COLUMNS,
+    MB52_KEY_COLUMNS,
+    STOCK_LAYER_KEYS,
+    StockCheckError,
+    build_transfer_plan,
+    build_transfer_sources,
+    check_issue,
+    export_excel,
+    load_issue,
+    summarize_report,
+    write_excel_sheets,
+)
+
+
+ISSUE_FILE_EXTENSIONS = (".xlsx", ".xls")
+RESULT_FILE_SUFFIX = "_KetQua.xlsx"
+ROLLUP_FILE_PREFIX = "StockFlow_TongHop"
+MB52_FILE_PREFIX = "mb52"
+# File IQ09 nam cung thu muc nhung khong phai phieu xuat kho.
+IGNORED_FILE_PREFIXES = ("iq09",)
+
+# (nhan hien thi, duong dan file, ten file trong zip hoac None)
+IssueTask = Tuple[str, str, Optional[str]]
+
+# Trang thai rieng cua moi process worker, nap mot lan trong initializer.
+BATCH_WORKER_STATE: Dict[str, Any] = {}
+
+
+def is_issue_file_name(name: str) -> bool:
+    base = os.path.basename(name)
+    return (
+        base.lower().endswith(ISSUE_FILE_EXTENSIONS)
+        and not base.startswith("~$")
+        and not base.endswith(RESULT_FILE_SUFFIX)
+        and not base.startswith(ROLLUP_FILE_PREFIX)
+    )
+
+
+def data_file_kind(name: str) -> Optional[str]:
+    # Thu muc du lieu chua lan MB52, IQ09 va phieu xuat kho: phan loai theo ten file.
+    lower = os.path.basename(name).lower()
+    if not lower.endswith(ISSUE_FILE_EXTENSIONS) or lower.startswith("~$") or lower.startswith(IGNORED_FILE_PREFIXES):
+        return None
+    if lower.startswith(MB52_FILE_PREFIX):
+        return "mb52"
+    return "issue" if is_issue_file_name(name) else None
+
+
+def collect_issue_tasks(inputs: list[str]) -> list[IssueTask]:
+    tasks = []
+    for source in inputs:
+        if os.path.isdir(source):
+            for name in sorted(os.listdir(source)):
+                path = os.path.join(source, name)
+                if os.path.isfile(path) and data_file_kind(name) == "issue":
+                    tasks.append((path, path, None))
+        elif zipfile.is_zipfile(source) and not source.lower().endswith(ISSUE_FILE_EXTENSIONS):
+            with zipfile.ZipFile(source) as archive:
+                for member in sorted(archive.namelist()):
+                    if not member.endswith("/") and data_file_kind(member) == "issue":
+                        tasks.append((f"{source}:{member}", source, member))
+        else:
+            tasks.append((source, source, None))
+    return tasks
+
+
+def read_issue_task_bytes(task: IssueTask) -> bytes:
+    _, path, member = task
+    if member is None:
+        with open(path, "rb") as file:
+            return file.read()
+    with zipfile.ZipFile(path) as archive:
+        return archive.read(member)
+
+
+def issue_result_path(task: IssueTask, output_dir: Optional[str]) -> str:
+    _, path, member = task
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if member is not None:
+        stem = f"{stem}_{os.path.splitext(os.path.basename(member))[0]}"
+    folder = output_dir or os.path.dirname(os.path.abspath(path))
+    return os.path.join(folder, f"{stem}{RESULT_FILE_SUFFIX}")
+
+
+def issue_result_paths(tasks: list[IssueTask], output_dir: Optional[str]) -> list[str]:
+    # Hai file cung ten o hai thu muc ghi chung --output-dir: them so thu tu de file sau khong de len file truoc.
+    paths = []
+    used: set[str] = set()
+    for task in tasks:
+        path = issue_result_path(task, output_dir)
+        base = path[: -len(RESULT_FILE_SUFFIX)]
+        counter = 1
+        while os.path.normcase(os.path.abspath(path)) in used:
+            counter += 1
+            path = f"{base}_{counter}{RESULT_FILE_SUFFIX}"
+        used.add(os.path.normcase(os.path.abspath(path)))
+        paths.append(path)
+    return paths
+
+
+def save_shared_array(folder: str, values: np.ndarray) -> str:
+    path = os.path.join(folder, f"{len(os.listdir(folder))}.npy")
+    np.save(path, np.ascontiguousarray(values), allow_pickle=False)
+    return path
+
+
+def save_shared_frame(folder: str, df: pd.DataFrame) -> Dict[str, str]:
+    return {col: save_shared_array(folder, df[col].to_numpy()) for col in df.columns}
+
+
+def open_shared_frame(paths: Dict[str, str]) -> pd.DataFrame:
+    # copy=False: moi cot tro thang vao vung nho map tu file, cac worker dung chung page cache cua OS.
+    return pd.DataFrame(
+        {col: np.load(path, mmap_mode="r").view(np.ndarray) for col, path in paths.items()},
+        copy=False,
+    )
+
+
+def write_shared_stock_index(stock_index: Dict[str, Any], folder: str) -> Dict[str, Any]:
+    # Ghi cac mang so cua chi muc MB52 ra .npy mot lan; worker chi nhan danh sach duong dan nay.
+    vocab = stock_index["vocab"]
+    manifest: Dict[str, Any] = {
+        "vocab": {col: save_shared_array(folder, np.asarray(vocab[col].to_numpy(), dtype=str)) for col in vocab},
+        "layers": {stock_col: save_shared_frame(folder, stock_index[stock_col]) for stock_col in STOCK_LAYER_KEYS},
+    }
+    # Nguon chuyen kho la dict Python, khong map duoc: luu bang ma (Material, Plant, Sloc, WBS, ton)
+    # theo dung thu tu tung Material, worker dung lai dict tu bang nay.
+    source_rows = [
+        (mat, plant, sloc, wbs, qty)
+        for mat, buckets in stock_index["sources"]["material"].items()
+        for plant, sloc, wbs, qty in buckets
+    ]
+    sources = pd.DataFrame(source_rows, columns=MB52_KEY_COLUMNS + ["Unrestricted"])
+    for col in MB52_KEY_COLUMNS:
+        sources[col] = vocab[col].get_indexer(sources[col]).astype(np.int32)
+    sources["Unrestricted"] = sources["Unrestricted"].astype(float)
+    manifest["sources"] = save_shared_frame(folder, sources)
+    return manifest
+
+
+def open_shared_stock_index(manifest: Dict[str, Any]) -> Dict[str, Any]:
+    vocab = {col: pd.Index(np.load(path, mmap_mode="r"), dtype="str") for col, path in manifest["vocab"].items()}
+    stock_index: Dict[str, Any] = {"vocab": vocab}
+    for stock_col, paths in manifest["layers"].items():
+        stock_index[stock_col] = open_shared_frame(paths)
+    stock_index["sources"] = build_transfer_sources(open_shared_frame(manifest["sources"]), vocab)
+    return stock_index
+
+
+def init_batch_worker(
+    stock_index: Dict[str, Any],
+    serial_index: Optional[Dict[str, Any]],
+    mb52_meta: Dict[str, str],
+    allocation: Optional[str] = None,
+) -> None:
+    # stock_index la manifest tu write_shared_stock_index (process worker) hoac chinh chi muc (chay tuan tu).
+    # Chi muc serial IQ09 nho, van di qua initargs.
+    if "layers" in stock_index:
+        stock_index = open_shared_stock_index(stock_index)
+    BATCH_WORKER_STATE["stock_index"] = stock_index
+    BATCH_WORKER_STATE["serial_index"] = serial_index
+    BATCH_WORKER_STATE["mb52_meta"] = mb52_meta
+    BATCH_WORKER_STATE["allocation"] = allocation
+
+
+def check_issue_task(task: IssueTask, output_path: str) -> Dict[str, Any]:
+    label = task[0]
+    try:
+        issue_df = load_issue(read_issue_task_bytes(task))
+    except (OSError, StockCheckError, ValueError, zipfile.BadZipFile) as exc:
+        return {"label": label, "error": str(exc)}
+
+    try:
+        final_report = check_issue(
+            issue_df,
+            None,
+            BATCH_WORKER_STATE["stock_index"],
+            serial_index=BATCH_WORKER_STATE.get("serial_index"),
+            allocation=BATCH_WORKER_STATE.get("allocation"),
+        )
+        transfer_plan = build_transfer_plan(final_report, BATCH_WORKER_STATE["stock_index"])
+        data = export_excel(final_report, issue_df, BATCH_WORKER_STATE["mb52_meta"], transfer_plan)
+        with open(output_path, "wb") as file:
+            file.write(data)
+    except Exception as exc:
+        # Mot phieu loi khi kiem tra/xuat bao cao khong duoc lam dung ca lo: ghi thanh dong loi trong file tong hop.
+        return {"label": label, "error": f"{type(exc).__name__}: {exc}"}
+
+    not_ok_detail = final_report.loc[~final_report[COL_OK], DETAIL_COLUMNS].copy()
+    not_ok_detail.insert(0, "File", label)
+    return {
+        "label": label,
+        "output": output_path,
+        "detail": not_ok_detail,
+        **summarize_report(final_report),
+    }
+
+
+def run_batch(
+    tasks: list[IssueTask],
+    stock_index: Dict[str, Any],
+    mb52_meta: Dict[str, str],
+    output_dir: Optional[str] = None,
+    workers: Optional[int] = None,
+    on_result=None,
+    serial_index: Optional[Dict[str, Any]] = None,
+    allocation: Optional[str] = None,
+) -> list[Dict[str, Any]]:
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+    output_paths = issue_result_paths(tasks, output_dir)
+    results = []
+
+    if workers == 1:
+        init_batch_worker(stock_index, serial_index, mb52_meta, allocation)
+        for task, output_path in zip(tasks, output_paths):
+            results.append(check_issue_task(task, output_path))
+            if on_result:
+                on_result(results[-1])
+        return results
+
+    shared_dir = tempfile.mkdtemp(prefix="stockflow_")
+    try:
+        manifest = write_shared_stock_index(stock_index, shared_dir)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_batch_worker,
+            initargs=(manifest, serial_index, mb52_meta, allocation),
+        ) as pool:
+            futures = {
+                pool.submit(check_issue_task, task, output_path): pos
+                for pos, (task, output_path) in enumerate(zip(tasks, output_paths))
+            }
+            ordered: list[Optional[Dict[str, Any]]] = [None] * len(tasks)
+            for future in concurrent.futures.as_completed(futures):
+                pos = futures[future]
+                try:
+                    ordered[pos] = future.result()
+                except Exception as exc:
+                    # Worker chet giua chung (BrokenProcessPool, het bo nho...): van tra dong loi cho file do.
+                    ordered[pos] = {"label": tasks[pos][0], "error": f"{type(exc).__name__}: {exc}"}
+                if on_result:
+                    on_result(ordered[pos])
+        results = [result for result in ordered if result is not None]
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+    return results
+
+
+def build_rollup_sheet(results: list[Dict[str, Any]]) -> pd.DataFrame:
+    rows = []
+    for result in results:
+        if result.get("error"):
+            rows.append({"File": result["label"], "Kết luận": f"Lỗi: {result['error']}"})
+            continue
+        total, ok, not_ok = result["total"], result["ok"], result["not_ok"]
+        rows.append(
+            {
+                "File": result["label"],
+                "Kết luận": (
+                    "ĐẢM BẢO XUẤT KHO 100%"
+                    if total > 0 and not_ok == 0
+                    else "CHƯA ĐẢM BẢO XUẤT KHO 100%"
+                ),
+                "Tổng dòng": total,
+                "Đã xuất đủ": ok,
+                "Chưa đảm bảo": not_ok,
+                "Tỷ lệ đảm bảo": f"{(ok / total * 100) if total else 0:.1f}%",
+                "File kết quả": result["output"],
+            }
+        )
+    return pd.DataFrame(
+        rows,
+        columns=["File", "Kết luận", "Tổng dòng", "Đã xuất đủ", "Chưa đảm bảo", "Tỷ lệ đảm bảo", "File kết quả"],
+    )
+
+
+def export_rollup_excel(results: list[Dict[str, Any]], mb52_meta: Dict[str, str]) -> bytes:
+    details = [result["detail"] for result in results if not result.get("error") and not result["detail"].empty]
+    sheets = [
+        ("TongHop", build_rollup_sheet(results)),
+        ("NguonMB52", pd.DataFrame(
+            [
+                {"Thông tin": "Nguồn MB52", "Giá trị": mb52_meta.get("source", "")},
+                {"Thông tin": "MB52 URL/Path", "Giá trị": mb52_meta.get("url", "")},
+                {"Thông tin": "Thời điểm kiểm tra", "Giá trị": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")},
+            ]
+        )),
+    ]
+    if details:
+        sheets.append(("ChiTietChuaDamBao", pd.concat(details, ignore_index=True)))
+    return write_excel_sheets(sheets)
+
+
+def rollup_path(tasks: list[IssueTask], output_dir: Optional[str]) -> str:
+    folder = output_dir or os.path.dirname(os.path.abspath(tasks[0][1]))
+    file_time = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(folder, f"{ROLLUP_FILE_PREFIX}_{file_time}.xlsx")
@@ -0,0 +1,328 @@
+# =====================================================
+# STOCKFLOW BENCH - DO THOI GIAN TUNG BUOC VOI DU LIEU GIA LAP
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+import stockflow_engine as engine
+
+
+# Dung thu tu cot nhu file xuat tu SAP: MB52 va PXK Export Tcode LXK (Actual Quantity = AB, Status = AC).
+MB52_COLUMNS = [
+    "Material",
+    "Material Description",
+    "Base Unit of Measure",
+    "Plant",
+    "Storage location",
+    "WBS Element",
+    "Unrestricted",
+    "Value Restricted",
+    "Name 1",
+    "Descr. of Storage Loc.",
+    "Currency",
+    "Value Unrestricted",
+    "Transit and Transfer",
+    "Val. in Trans./Tfr",
+    "Quality Inspection",
+    "Blocked",
+]
+ISSUE_COLUMNS = [
+    "Request Number",
+    "Request Number.1",
+    "Reservation",
+    "Reservation Number",
+    "Material Number",
+    "Material Description",
+    "Plant",
+    "Plant Name",
+    "UOM",
+    "Project",
+    "Project Name",
+    "Source WBS",
+    "Source WBS Name",
+    "Target WBS",
+    "Target WBS Name",
+    "Functional Location",
+    "Sending Sloc",
+    "Sending Sloc Name",
+    "Contractor Sloc",
+    "Contrator Sloc Name",
+    "Vendor",
+    "Vendor Name",
+    "Construction Contract",
+    "Requirement Quantity",
+    "Transferred Quantity",
+    "Freeze Quantity",
+    "Transfer Quantity",
+    "Actual Quantity",
+    "Status",
+    "Status Description",
+    "Receiving Org",
+    "Receiving Org Name",
+    "Name of Receiver",
+    "Employee",
+    "Phone",
+    "Requesting Org",
+    "Requesting Org Name",
+    "Delete Flag",
+    "Reject Reason",
+    "Note",
+    "Message",
+]
+
+BENCH_PLANTS = ["N013", "N400", "V013", "V400"]
+BENCH_SLOCS = {"N013": ["N301", "N302"], "N400": ["AG01", "KG01"], "V013": ["V301", "V302"], "V400": ["AG02", "KG02"]}
+BENCH_STATUSES = ["1", "5", "9", "12"]
+BENCH_STATUS_WEIGHTS = [0.1, 0.15, 0.25, 0.5]
+BENCH_STATUS_NAMES = {"1": "Created", "5": "Approved", "9": "Published", "12": "Issued"}
+BENCH_DEFAULT_SIZES = [1_000, 10_000, 100_000]
+NBSP = "\u00a0"
+
+
+def bench_material_pool(rng: np.random.Generator, mb52_rows: int) -> np.ndarray:
+    count = max(50, mb52_rows // 15)
+    return np.sort(rng.choice(np.arange(200_000_001, 200_000_001 + count * 4), size=count, replace=False))
+
+
+def bench_wbs_pool(rng: np.random.Generator, mb52_rows: int) -> np.ndarray:
+    count = max(20, mb52_rows // 6)
+    projects = rng.choice(np.arange(1, 900_000), size=count, replace=False)
+    return np.array([f"TE-{project:06d}-D-01" for project in projects], dtype=object)
+
+
+def pollute_keys(values: np.ndarray, rng: np.random.Generator, rate: float, prefix: str = "", suffix: str = "") -> np.ndarray:
+    # Mo phong du lieu dan tu Excel/SAP: NBSP cuoi khoa, so 0 dau ma vat tu.
+    values = values.astype(object)
+    dirty = rng.random(len(values)) < rate
+    values[dirty] = [f"{prefix}{value}{suffix}" for value in values[dirty]]
+    return values
+
+
+def generate_mb52_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    materials = bench_material_pool(rng, rows)
+    wbs_pool = bench_wbs_pool(rng, rows)
+
+    material = materials[rng.integers(0, len(materials), rows)]
+    plant = np.array(BENCH_PLANTS, dtype=object)[rng.integers(0, len(BENCH_PLANTS), rows)]
+    sloc = np.array([BENCH_SLOCS[p][i] for p, i in zip(plant, rng.integers(0, 2, rows))], dtype=object)
+    wbs = wbs_pool[rng.integers(0, len(wbs_pool), rows)].copy()
+    wbs[rng.random(rows) < 0.3] = np.nan
+    unrestricted = np.where(rng.random(rows) < 0.2, 0, rng.integers(1, 500, rows))
+
+    material_col = material.astype(object)
+    text_material = rng.random(rows) < 0.1
+    material_col[text_material] = [f"000{value}" for value in material[text_material]]
+
+    return pd.DataFrame(
+        {
+            "Material": material_col,
+            "Material Description": [f"Vat tu {value}" for value in material],
+            "Base Unit of Measure": "CAI",
+            "Plant": plant,
+            "Storage location": pollute_keys(sloc, rng, 0.05, suffix=NBSP),
+            "WBS Element": wbs,
+            "Unrestricted": unrestricted,
+            "Value Restricted": 0,
+            "Name 1": "VTN KV3",
+            "Descr. of Storage Loc.": "TS tot",
+            "Currency": "VND",
+            "Value Unrestricted": unrestricted * 25_000,
+            "Transit and Transfer": 0,
+            "Val. in Trans./Tfr": 0,
+            "Quality Inspection": 0,
+            "Blocked": 0,
+        },
+        columns=MB52_COLUMNS,
+    )
+
+
+def generate_issue_frame(mb52_df: pd.DataFrame, rows: int, seed: int = 1) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    # 80% dong lay khoa co trong MB52 de di qua du 5 tang, phan con lai la ma/kho/WBS lech.
+    picks = rng.integers(0, len(mb52_df), rows)
+    source = mb52_df.iloc[picks].reset_index(drop=True)
+    material = source["Material"].astype(str).str.lstrip("0").to_numpy(dtype=object)
+    plant = source["Plant"].to_numpy(dtype=object)
+    sloc = source["Storage location"].astype(str).str.strip().to_numpy(dtype=object)
+    wbs = source["WBS Element"].fillna("TE-000001-D-01").to_numpy(dtype=object)
+
+    foreign = rng.random(rows) < 0.2
+    material[foreign] = (rng.integers(300_000_001, 300_100_000, foreign.sum())).astype(str)
+    material = pollute_keys(material, rng, 0.15, prefix="000")
+    wbs = pollute_keys(wbs, rng, 0.05, suffix=NBSP)
+
+    status = rng.choice(BENCH_STATUSES, size=rows, p=BENCH_STATUS_WEIGHTS)
+    transfer_qty = rng.integers(1, 80, rows).astype(float)
+    exported = status == "12"
+    delta = rng.choice([0, 0, 0, -1, 1], size=rows)
+    actual_qty = np.where(exported, np.maximum(transfer_qty + delta, 0), 0)
+    request = 1_000_800_000 + rng.integers(0, max(rows // 10, 1), rows)
+    fl = np.array([f"EKG{value:07d}" for value in rng.integers(0, max(rows // 20, 1), rows)], dtype=object)
+
+    return pd.DataFrame(
+        {
+            "Request Number": request,
+            "Request Number.1": np.arange(1, rows + 1),
+            "Reservation": 3_881_850 + request % 1000,
+            "Reservation Number": np.arange(rows) % 50 + 1,
+            "Material Number": material,
+            "Material Description": [f"Vat tu {value}" for value in material],
+            "Plant": plant,
+            "Plant Name": "CN",
+            "UOM": "CAI",
+            "Project": [value[:9] for value in wbs],
+            "Project Name": "Du an",
+            "Source WBS": wbs,
+            "Source WBS Name": "Mua sam VTTB",
+            "Target WBS": [f"{value}-BDS" for value in wbs],
+            "Target WBS Name": "Tram BTS",
+            "Functional Location": fl,
+            "Sending Sloc": sloc,
+            "Sending Sloc Name": "TS tot",
+            "Contractor Sloc": "N999",
+            "Contrator Sloc Name": "Kho nha thau",
+            "Vendor": "VCC",
+            "Vendor Name": "VCC",
+            "Construction Contract": "HD-0001",
+            "Requirement Quantity": transfer_qty,
+            "Transferred Quantity": 0,
+            "Freeze Quantity": 0,
+            "Transfer Quantity": transfer_qty,
+            "Actual Quantity": actual_qty,
+            "Status": status.astype(int),
+            "Status Description": [BENCH_STATUS_NAMES[value] for value in status],
+            "Receiving Org": 163502,
+            "Receiving Org Name": "VIETTEL",
+            "Name of Receiver": np.nan,
+            "Employee": np.nan,
+            "Phone": np.nan,
+            "Requesting Org": 201090,
+            "Requesting Org Name": "Tro ly",
+            "Delete Flag": np.nan,
+            "Reject Reason": np.nan,
+            "Note": "Xuat vat tu",
+            "Message": np.nan,
+        },
+        columns=ISSUE_COLUMNS,
+    )
+
+
+def frame_to_xlsx_bytes(df: pd.DataFrame) -> bytes:
+    return engine.write_excel_sheets([("Sheet1", df)])
+
+
+def timed(stages: Dict[str, Dict[str, Any]], name: str, func: Callable[[], Any], rows: Optional[int] = None) -> Any:
+    started = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - started
+    stage = stages.setdefault(name, {"runs": []})
+    stage["runs"].append(round(seconds, 6))
+    stage["seconds"] = min(stage["runs"])
+    if rows is not None:
+        stage["rows"] = rows
+    return result
+
+
+def run_benchmark(mb52_rows: int, issue_rows: int, repeat: int = 1, seed: int = 0) -> Dict[str, Any]:
+    mb52_df = generate_mb52_frame(mb52_rows, seed)
+    issue_df_raw = generate_issue_frame(mb52_df, issue_rows, seed + 1)
+    mb52_bytes = frame_to_xlsx_bytes(mb52_df)
+    issue_bytes = frame_to_xlsx_bytes(issue_df_raw)
+    stages: Dict[str, Dict[str, Any]] = {}
+
+    cache_dir = engine.MB52_CACHE_DIR
+    with tempfile.TemporaryDirectory(prefix="stockflow_bench_") as temp_cache:
+        # Cache rieng cho bench: lan dau do doc XLSX that, lan sau do doc tu cache Parquet.
+        engine.MB52_CACHE_DIR = temp_cache
+        try:
+            for _ in range(repeat):
+                for name in os.listdir(temp_cache):
+                    os.remove(os.path.join(temp_cache, name))
+                mb52_raw = timed(stages, "load_mb52", lambda: engine.load_mb52(mb52_bytes), mb52_rows)
+                timed(stages, "load_mb52_cached", lambda: engine.load_mb52(mb52_bytes), mb52_rows)
+        finally:
+            engine.MB52_CACHE_DIR = cache_dir
+
+    for _ in range(repeat):
+        issue_df = timed(stages, "load_issue", lambda: engine.load_issue(issue_bytes), issue_rows)
+        stock_index = timed(stages, "build_stock_index", lambda: engine.build_stock_index(mb52_raw), mb52_rows)
+        pending = timed(
+            stages,
+            "build_pending_stock_report",
+            lambda: engine.build_pending_stock_report(issue_df, mb52_raw, stock_index),
+            issue_rows,
+        )
+        exported = timed(stages, "build_exported_status_report", lambda: engine.build_exported_status_report(issue_df), issue_rows)
+        final_report = engine.build_business_conclusion(
+            pd.concat([df for df in [pending, exported] if not df.empty], ignore_index=True, sort=False)
+        )
+        timed(stages, "build_stock_summaries", lambda: engine.build_stock_summaries(final_report), len(final_report))
+        timed(stages, "export_excel", lambda: engine.export_excel(final_report, issue_df, {}), len(final_report))
+
+    return {
+        "mb52_rows": mb52_rows,
+        "issue_rows": issue_rows,
+        "mb52_xlsx_bytes": len(mb52_bytes),
+        "issue_xlsx_bytes": len(issue_bytes),
+        "report_rows": len(final_report),
+        "stages": stages,
+    }
+
+
+def default_issue_rows(mb52_rows: int) -> int:
+    return int(min(max(mb52_rows // 20, 500), 50_000))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="stockflow-bench", description="Đo thời gian từng bước kiểm tra với MB52/PXK giả lập.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCH_DEFAULT_SIZES, help="Số dòng MB52 (1k đến 1M)")
+    parser.add_argument("--issue-rows", type=int, help="Số dòng phiếu (mặc định: MB52/20, trong khoảng 500-50k)")
+    parser.add_argument("--repeat", type=int, default=1, help="Số lần lặp, lấy thời gian nhỏ nhất")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json", help="File JSON kết quả")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    results = []
+    for mb52_rows in args.sizes:
+        issue_rows = args.issue_rows or default_issue_rows(mb52_rows)
+        result = run_benchmark(mb52_rows, issue_rows, args.repeat, args.seed)
+        results.append(result)
+        stage_text = " · ".join(f"{name} {stage['seconds']:.3f}s" for name, stage in result["stages"].items())
+        print(f"MB52 {mb52_rows:,} / PXK {issue_rows:,}: {stage_text}")
+
+    payload = {
+        "app_version": engine.APP_VERSION,
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "seed": args.seed,
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(payload, file, ensure_ascii=False, indent=2)
+    print(f"Đã ghi {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,113 @@
+# =====================================================
+# STOCKFLOW CLI - KIEM TRA PHIEU XUAT KHO KHONG CAN GIAO DIEN
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import argparse
+import os
+import sys
+from typing import Any, Dict, Optional
+
+from stockflow_batch import collect_issue_tasks, export_rollup_excel, rollup_path, run_batch
+from stockflow_engine import (
+    ALLOCATION_ORDERS,
+    APP_VERSION,
+    LOCAL_MB52_PATH,
+    StockCheckError,
+    build_serial_index,
+    build_stock_index,
+    load_iq09,
+    load_mb52,
+    read_mb52_source,
+)
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    if result.get("error"):
+        print(f"{result['label']}: lỗi {result['error']}", file=sys.stderr)
+        return
+    print(
+        f"{result['label']}: {result['total']:,} dòng · đã xuất đủ {result['ok']:,} · "
+        f"chưa đảm bảo {result['not_ok']:,} -> {result['output']}"
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stockflow",
+        description="Kiểm tra phiếu xuất kho (PXK) theo trạng thái thực xuất và tồn kho MB52.",
+    )
+    parser.add_argument("issues", nargs="+", help="File phiếu xuất kho (.xlsx), thư mục hoặc file .zip")
+    parser.add_argument(
+        "--mb52",
+        default=LOCAL_MB52_PATH,
+        help=f"File MB52 hoặc GitHub Raw URL (mặc định: {LOCAL_MB52_PATH})",
+    )
+    parser.add_argument("--iq09", help="File IQ09 để kiểm tra serial khả dụng (mặc định: không kiểm tra serial)")
+    parser.add_argument(
+        "--allocation",
+        choices=list(ALLOCATION_ORDERS),
+        help="Phân bổ tồn kho giữa các dòng theo thứ tự: "
+        + ", ".join(f"{order} = {label}" for order, label in ALLOCATION_ORDERS.items())
+        + " (mặc định: kiểm tra độc lập từng dòng)",
+    )
+    parser.add_argument("--output-dir", help="Thư mục ghi file kết quả (mặc định: cạnh file phiếu)")
+    parser.add_argument("--workers", type=int, help="Số process kiểm tra song song (mặc định: số CPU)")
+    parser.add_argument("--no-rollup", action="store_true", help="Không ghi file tổng hợp khi kiểm tra nhiều phiếu")
+    parser.add_argument("--version", action="version", version=f"%(prog)s {APP_VERSION}")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    try:
+        mb52_bytes, mb52_meta = read_mb52_source(args.mb52)
+        mb52_raw = load_mb52(mb52_bytes, mb52_meta)
+    except (OSError, StockCheckError, ValueError) as exc:
+        print(f"MB52 lỗi: {exc}", file=sys.stderr)
+        return 2
+    stock_index = build_stock_index(mb52_raw)
+    print(f"MB52: {len(mb52_raw):,} dòng · {mb52_raw['Material'].nunique():,} mã vật tư · {mb52_meta.get('source', '')}")
+
+    serial_index = None
+    if args.iq09:
+        try:
+            with open(args.iq09, "rb") as file:
+                serial_index = build_serial_index(load_iq09(file.read()))
+        except (OSError, StockCheckError, ValueError) as exc:
+            print(f"IQ09 lỗi: {exc}", file=sys.stderr)
+            return 2
+        print(f"IQ09: {serial_index['usable_count']:,} serial khả dụng · {len(serial_index['materials']):,} mã vật tư quản lý serial")
+
+    tasks = collect_issue_tasks(args.issues)
+    if not tasks:
+        print("Không tìm thấy file phiếu xuất kho nào.", file=sys.stderr)
+        return 2
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    results = run_batch(
+        tasks,
+        stock_index,
+        mb52_meta,
+        args.output_dir,
+        args.workers,
+        on_result=print_result,
+        serial_index=serial_index,
+        allocation=args.allocation,
+    )
+
+    if len(tasks) > 1 and not args.no_rollup:
+        output_path = rollup_path(tasks, args.output_dir)
+        with open(output_path, "wb") as file:
+            file.write(export_rollup_excel(results, mb52_meta))
+        print(f"Tổng hợp {len(results)} file -> {output_path}")
+
+    failed = sum(1 for result in results if result.get("error"))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
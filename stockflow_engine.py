@@ -0,0 +1,2425 @@
+# =====================================================
+# STOCKFLOW ENGINE - LOI KIEM TRA 5 TANG (KHONG CAN STREAMLIT)
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import bisect
+import codecs
+import contextlib
+import datetime
+import functools
+import hashlib
+import heapq
+import html
+import io
+import json
+import os
+import posixpath
+import re
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import requests
+import requests.adapters
+from openpyxl.styles import Alignment, Font, PatternFill
+from openpyxl.styles.numbers import builtin_format_code, is_date_format, is_timedelta_format
+from openpyxl.utils import column_index_from_string, get_column_letter
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+from pandas.io.parsers import TextParser
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# =====================================================
+# CONFIG
+# =====================================================
+DEFAULT_MB52_RAW_URL = "https://raw.githubusercontent.com/datnguyensg28/StockChecker/main/data/MB52.XLSX"
+LOCAL_MB52_PATH = "data/MB52.XLSX"
+LOCAL_IQ09_PATH = "data/IQ09.XLSX"
+MB52_CACHE_DIR = "cache/mb52"
+MB52_CACHE_MAX_BYTES = 256 * 1024 * 1024
+MB52_CACHE_VERSION = 2
+MB52_HISTORY_DIR = "history/mb52"
+HTTP_CACHE_DIR = "cache/http"
+CHECK_RESULT_CACHE_MAX_ENTRIES = 32
+STAGE_LOG_PATH = "logs/stockflow_stages.jsonl"
+
+APP_VERSION = "3.0"
+
+REQUIRED_MB52_COLUMNS = ["Material", "Plant", "Unrestricted", "WBS Element"]
+REQUIRED_IQ09_COLUMNS = ["ManufactSerialNumber", "Material", "Plant", "User Status"]
+IQ09_WBS_COLUMN_NAMES = {"wbs serial data", "wbs element"}
+# Serial o trang thai nay moi duoc xuat kho; GOOD INST da lap dat, GOOD VEND WH dang o kho nha cung cap.
+IQ09_USABLE_STATUSES = {"GOOD", "GOOD WH"}
+REQUIRED_ISSUE_COLUMNS = [
+    "Request Number",
+    "Material Number",
+    "Material Description",
+    "Plant",
+    "Source WBS",
+    "Sending Sloc",
+    "Functional Location",
+    "Transfer Quantity",
+]
+# Cot khoa cua phieu: True = bo so 0 o dau khi chuan hoa.
+ISSUE_KEY_STRIP_ZEROS = {"Material Number": True, "Plant": False, "Sending Sloc": True, "Source WBS": False}
+
+DETAIL_COLUMNS = [
+    "Request Number",
+    "Material Number",
+    "Material Description",
+    "Plant",
+    "Source WBS",
+    "Sending Sloc",
+    "Functional Location",
+    "Transfer Quantity",
+    "Actual Quantity",
+    "Status",
+    "Kh\u00f3a ki\u1ec3m tra MB52",
+    "S\u1ed1 d\u00f2ng MB52 kh\u1edbp",
+    "T\u1ed3n kho \u0111\u00fang kh\u00f3a MB52",
+    "Số lượng cần xử lý",
+    "Còn thiếu",
+    "Tình trạng",
+    "Gợi ý xử lý",
+]
+
+STOCK_COLUMNS = [
+    "Tồn kho DA CN",
+    "Tồn kho DA Tỉnh",
+    "Tồn kho CN",
+    "Tồn kho Tỉnh",
+    "Tồn kho Khu vực",
+]
+
+STOCK_DETAIL_COLUMNS = DETAIL_COLUMNS + [
+    "Tầng đáp ứng",
+    "Tồn kho DA CN",
+    "Tồn kho DA Tỉnh",
+    "Tồn kho CN",
+    "Tồn kho Tỉnh",
+    "Tồn kho Khu vực",
+    "Gợi ý chuyển WBS",
+    "Report Status",
+]
+
+
+# =====================================================
+# HELPERS
+# =====================================================
+def normalize_key_value(value: Any, strip_leading_zeros: bool = False) -> str:
+    if pd.isna(value):
+        return ""
+
+    if isinstance(value, int):
+        text = str(value)
+    elif isinstance(value, float):
+        text = str(int(value)) if value.is_integer() else str(value).strip()
+    else:
+        text = str(value).replace("\u00a0", " ").strip()
+        if text.endswith(".0"):
+            numeric_part = text[:-2]
+            if numeric_part.replace("-", "", 1).isdigit():
+                text = numeric_part
+
+    text = " ".join(text.split()).upper()
+    if strip_leading_zeros and text.isdigit():
+        text = text.lstrip("0") or "0"
+    return text
+
+
+def normalize_unique_keys(uniques: np.ndarray, strip_leading_zeros: bool = False) -> pd.Series:
+    texts = []
+    is_text = []
+    for value in uniques:
+        if isinstance(value, int):
+            texts.append(str(value))
+            is_text.append(False)
+        elif isinstance(value, float):
+            texts.append(str(int(value)) if value.is_integer() else str(value).strip())
+            is_text.append(False)
+        else:
+            texts.append(str(value))
+            is_text.append(True)
+
+    keys = pd.Series(texts, dtype=object)
+    is_text = np.array(is_text, dtype=bool)
+    if is_text.any():
+        text = keys[is_text].str.replace("\u00a0", " ", regex=False).str.strip()
+        numeric_part = text.str[:-2]
+        float_artifact = text.str.endswith(".0") & numeric_part.str.replace("-", "", n=1, regex=False).str.isdigit()
+        keys[is_text] = text.where(~float_artifact, numeric_part)
+
+    keys = keys.str.split().str.join(" ").str.upper()
+    if strip_leading_zeros:
+        digits = keys.str.isdigit().astype(bool)
+        keys[digits] = keys[digits].str.lstrip("0").replace("", "0")
+    return keys
+
+
+def normalize_key_series(values: pd.Series, strip_leading_zeros: bool = False) -> pd.Series:
+    # Chuan hoa theo gia tri duy nhat roi map nguoc lai, ket qua giong het normalize_key_value tung o.
+    raw = values.to_numpy(dtype=object)
+    bool_mask = None
+    if values.dtype == object:
+        bool_mask = np.frompyfunc(lambda value: isinstance(value, (bool, np.bool_)), 1, 1)(raw).astype(bool)
+        if bool_mask.any():
+            raw = np.where(bool_mask, None, raw)
+        else:
+            bool_mask = None
+
+    codes, uniques = pd.factorize(raw)
+    keys = np.append(normalize_unique_keys(uniques, strip_leading_zeros).to_numpy(dtype=object), "")
+    result = keys[codes]
+    if bool_mask is not None:
+        result[bool_mask] = [
+            normalize_key_value(value, strip_leading_zeros)
+            for value in values.to_numpy(dtype=object)[bool_mask]
+        ]
+    return pd.Series(result, index=values.index, name=values.name)
+
+
+def normalize_material_key(value: Any) -> str:
+    return normalize_key_value(value, strip_leading_zeros=True)
+
+
+def normalize_sloc_key(value: Any) -> str:
+    return normalize_key_value(value, strip_leading_zeros=True)
+
+
+def normalize_wbs_key(value: Any) -> str:
+    return normalize_key_value(value, strip_leading_zeros=False)
+
+
+def normalize_column_name(value: Any) -> str:
+    return str(value).strip().lower()
+
+
+class StockCheckError(ValueError):
+    pass
+
+
+def validate_columns(df: pd.DataFrame, required_cols: list[str], file_label: str) -> None:
+    missing = [col for col in required_cols if col not in df.columns]
+    if missing:
+        raise StockCheckError(f"File {file_label} thiếu cột bắt buộc: {', '.join(missing)}")
+
+
+def detect_storage_location_column(df: pd.DataFrame) -> Optional[str]:
+    exact_candidates = [c for c in df.columns if normalize_column_name(c) == "storage location"]
+    if exact_candidates:
+        return exact_candidates[0]
+
+    fuzzy_candidates = [
+        c
+        for c in df.columns
+        if "storage" in normalize_column_name(c) and "location" in normalize_column_name(c)
+    ]
+    if fuzzy_candidates:
+        return fuzzy_candidates[0]
+    return None
+
+
+def detect_column_by_name_or_position(
+    df: pd.DataFrame,
+    accepted_names: list[str],
+    excel_column_index: int,
+    display_name: str,
+) -> str:
+    normalized_names = {name.strip().lower() for name in accepted_names}
+    for col in df.columns:
+        if normalize_column_name(col) in normalized_names:
+            return col
+
+    zero_based_index = excel_column_index - 1
+    if len(df.columns) > zero_based_index:
+        return df.columns[zero_based_index]
+
+    raise StockCheckError(
+        f"Không tìm thấy cột {display_name}. "
+        f"Hãy đặt tên cột là {accepted_names[0]} hoặc đặt đúng vị trí cột Excel."
+    )
+
+
+def normalize_status(value: Any) -> str:
+    text = normalize_key_value(value, strip_leading_zeros=True)
+    return text
+
+
+def is_exported_status(value: Any) -> bool:
+    return normalize_status(value) == "12"
+
+
+def content_digest(file_bytes: bytes) -> str:
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def write_file_atomic(path: str, write: Callable[[str], None]) -> None:
+    # Ghi ra file tam roi doi ten, de process khac khong bao gio doc phai file ghi do.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def peak_rss_mb() -> Optional[float]:
+    # Dinh bo nho thuc (RSS) cua process tu luc khoi dong; tracemalloc qua cham de bat thuong xuyen.
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+    if psutil is not None:
+        return getattr(psutil.Process().memory_info(), "peak_wset", 0) / 2**20 or None
+    return None
+
+
+class StageTimer:
+    def __init__(self):
+        self.records: list[Dict[str, Any]] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows: Optional[int] = None):
+        record: Dict[str, Any] = {"stage": name, "seconds": 0.0, "rows": rows}
+        # Them ngay khi bat dau de buoc long ben trong hien sau buoc cha, theo dung thu tu chay.
+        self.records.append(record)
+        peak_before = peak_rss_mb()
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - started, 4)
+            peak_after = peak_rss_mb()
+            record["peak_rss_mb"] = round(peak_after, 1) if peak_after is not None else None
+            record["peak_rss_growth_mb"] = (
+                round(peak_after - peak_before, 1) if peak_after is not None and peak_before is not None else None
+            )
+
+    def write_log(self, path: str = STAGE_LOG_PATH, **context: Any) -> None:
+        entry = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+            **context,
+            "stages": self.records,
+        }
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+        except OSError:
+            pass
+
+
+def timed_stage(timer: Optional[StageTimer], name: str, rows: Optional[int] = None):
+    if timer is None:
+        return contextlib.nullcontext({})
+    return timer.stage(name, rows)
+
+
+@functools.lru_cache(maxsize=None)
+def get_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def http_cache_path(url: str, suffix: str) -> str:
+    return os.path.join(HTTP_CACHE_DIR, hashlib.sha256(url.encode("utf-8")).hexdigest() + suffix)
+
+
+def read_http_cache(url: str) -> Tuple[Optional[bytes], Dict[str, str]]:
+    try:
+        with open(http_cache_path(url, ".json"), encoding="utf-8") as file:
+            validators = json.load(file)
+        with open(http_cache_path(url, ".body"), "rb") as file:
+            body = file.read()
+    except (OSError, ValueError):
+        return None, {}
+    if validators.get("sha256") != content_digest(body):
+        return None, {}
+    return body, validators
+
+
+def write_http_cache(url: str, body: bytes, validators: Dict[str, str]) -> None:
+    try:
+        os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+
+        def write_body(path: str) -> None:
+            with open(path, "wb") as file:
+                file.write(body)
+
+        def write_validators(path: str) -> None:
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump({**validators, "sha256": content_digest(body)}, file, indent=2)
+
+        write_file_atomic(http_cache_path(url, ".body"), write_body)
+        write_file_atomic(http_cache_path(url, ".json"), write_validators)
+    except OSError:
+        pass
+
+
+def drop_http_cache(url: str) -> None:
+    for suffix in (".json", ".body"):
+        try:
+            os.remove(http_cache_path(url, suffix))
+        except OSError:
+            pass
+
+
+def download_mb52_from_github(raw_url: str) -> Tuple[bytes, Dict[str, str]]:
+    if not raw_url:
+        raise ValueError("Chưa cấu hình GitHub Raw URL MB52.")
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "Pragma": "no-cache",
+        "User-Agent": f"StockFlow-Checker/{APP_VERSION}",
+    }
+    cached_body, validators = read_http_cache(raw_url)
+    if cached_body is not None:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    session = get_http_session()
+    response = session.get(raw_url, headers=headers, timeout=60)
+    if response.status_code == 304 and cached_body is None:
+        # 304 ma khong co body hop le trong cache (mat/hong): bo validator, tai lai khong dieu kien.
+        drop_http_cache(raw_url)
+        headers.pop("If-None-Match", None)
+        headers.pop("If-Modified-Since", None)
+        validators = {}
+        response = session.get(raw_url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            raise StockCheckError("Máy chủ trả 304 nhưng cache MB52 không còn dữ liệu.")
+    if response.status_code == 304 and cached_body is not None:
+        content = cached_body
+    else:
+        response.raise_for_status()
+        content = response.content
+        validators = {
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": response.headers.get("Last-Modified", ""),
+        }
+        if validators["etag"] or validators["last_modified"]:
+            write_http_cache(raw_url, content, validators)
+
+    meta = {
+        "source": "GitHub - MB52 mới nhất",
+        "url": raw_url,
+        "loaded_at": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        "last_modified": response.headers.get("Last-Modified", validators.get("last_modified", "")),
+        "etag": response.headers.get("ETag", validators.get("etag", "")),
+        "http_status": str(response.status_code),
+        "sha256": content_digest(content),
+    }
+    return content, meta
+
+
+def read_local_mb52(path: str) -> Tuple[bytes, Dict[str, str]]:
+    with open(path, "rb") as file:
+        content = file.read()
+    meta = {
+        "source": f"Local - {path}",
+        "url": path,
+        "loaded_at": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+        "last_modified": "",
+        "etag": "",
+        "sha256": content_digest(content),
+    }
+    return content, meta
+
+
+XLSX_MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+XLSX_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+XLSX_PACKAGE_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+XLSX_READ_CHUNK_SIZE = 1 << 20
+XLSX_SHEET_DATA_PATTERN = re.compile(r"<(\w+:)?sheetData\b")
+XLSX_TEXT_PATTERN = re.compile(r"<(\w+:)?t\b[^>]*?(?:/>|>([^<]*)</(?:\w+:)?t>)")
+XLSX_PHONETIC_PATTERN = re.compile(r"<(\w+:)?rPh\b.*?</(?:\w+:)?rPh>", re.S)
+
+
+class UnsupportedSheetLayout(ValueError):
+    pass
+
+
+def xlsx_first_sheet_path(archive: zipfile.ZipFile) -> str:
+    workbook = ET.fromstring(archive.read("xl/workbook.xml"))
+    first_sheet = workbook.find(f"{XLSX_MAIN_NS}sheets/{XLSX_MAIN_NS}sheet")
+    rel_id = first_sheet.get(f"{XLSX_REL_NS}id")
+    rels = ET.fromstring(archive.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.iter(f"{XLSX_PACKAGE_REL_NS}Relationship"):
+        if rel.get("Id") == rel_id:
+            target = rel.get("Target")
+            if target.startswith("/"):
+                return target.lstrip("/")
+            return posixpath.normpath(posixpath.join("xl", target))
+    raise KeyError(f"Không tìm thấy sheet {rel_id} trong workbook.")
+
+
+def xlsx_epoch(archive: zipfile.ZipFile) -> datetime.datetime:
+    workbook_pr = ET.fromstring(archive.read("xl/workbook.xml")).find(f"{XLSX_MAIN_NS}workbookPr")
+    date1904 = workbook_pr is not None and workbook_pr.get("date1904", "").lower() in ("1", "true")
+    return CALENDAR_MAC_1904 if date1904 else CALENDAR_WINDOWS_1900
+
+
+def read_xlsx_date_styles(archive: zipfile.ZipFile) -> Dict[str, bool]:
+    # Style (chi so cellXfs) co numFmt ngay gio -> True neu la dang khoang thoi gian ([h]:mm...), nhu openpyxl.
+    if "xl/styles.xml" not in archive.namelist():
+        return {}
+    styles = ET.fromstring(archive.read("xl/styles.xml"))
+    custom_formats = {
+        int(num_fmt.get("numFmtId")): num_fmt.get("formatCode")
+        for num_fmt in styles.iterfind(f"{XLSX_MAIN_NS}numFmts/{XLSX_MAIN_NS}numFmt")
+    }
+    date_styles = {}
+    for position, xf in enumerate(styles.iterfind(f"{XLSX_MAIN_NS}cellXfs/{XLSX_MAIN_NS}xf")):
+        num_fmt_id = int(xf.get("numFmtId", 0))
+        fmt = custom_formats.get(num_fmt_id) or builtin_format_code(num_fmt_id)
+        if is_date_format(fmt):
+            date_styles[str(position)] = is_timedelta_format(fmt)
+    return date_styles
+
+
+def read_xlsx_shared_strings(archive: zipfile.ZipFile) -> list[str]:
+    if "xl/sharedStrings.xml" not in archive.namelist():
+        return []
+    strings = []
+    with archive.open("xl/sharedStrings.xml") as xml_source:
+        for _, element in ET.iterparse(xml_source):
+            if element.tag != f"{XLSX_MAIN_NS}si":
+                continue
+            # Giong openpyxl: noi <t> va <r><t>, bo qua phien am <rPh>.
+            parts = []
+            for child in element:
+                if child.tag == f"{XLSX_MAIN_NS}t":
+                    parts.append(child.text or "")
+                elif child.tag == f"{XLSX_MAIN_NS}r":
+                    parts.append(child.findtext(f"{XLSX_MAIN_NS}t") or "")
+            strings.append("".join(parts).replace("x005F_", ""))
+            element.clear()
+    return strings
+
+
+def iter_xlsx_row_chunks(xml_source):
+    # Giai nen va cat XML sheet theo tung khoi ket thuc tai </row>, khong giu ca sheet trong bo nho.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    row_close = None
+    while True:
+        chunk = xml_source.read(XLSX_READ_CHUNK_SIZE)
+        pending += decoder.decode(chunk, final=not chunk)
+        if not chunk:
+            if pending:
+                yield pending
+            return
+        if row_close is None:
+            match = XLSX_SHEET_DATA_PATTERN.search(pending)
+            if match is None:
+                continue
+            row_close = f"</{match.group(1) or ''}row>"
+        cut = pending.rfind(row_close)
+        if cut >= 0:
+            cut += len(row_close)
+            yield pending[:cut]
+            pending = pending[cut:]
+
+
+def xlsx_cell_text(cell_type: str, inner: Optional[str], prefix: str) -> Optional[str]:
+    if not inner:
+        return None
+    if cell_type == "inlineStr":
+        inner = XLSX_PHONETIC_PATTERN.sub("", inner)
+        text = "".join(match.group(2) or "" for match in XLSX_TEXT_PATTERN.finditer(inner))
+    else:
+        start = inner.find(f"<{prefix}v>")
+        if start < 0:
+            return None
+        start += len(prefix) + 3
+        text = inner[start:inner.find("<", start)] or None
+    if text and "&" in text:
+        text = html.unescape(text)
+    return text
+
+
+def convert_xlsx_cell(cell_type: str, text: Optional[str], shared_strings: list[str]) -> Any:
+    # Cung gia tri voi openpyxl (read_only, data_only) + pandas _convert_cell.
+    if cell_type == "inlineStr":
+        return text if text is not None else ""
+    if not text:
+        return ""
+    if cell_type == "n":
+        number = float(text) if ("." in text or "E" in text or "e" in text) else int(text)
+        as_int = int(number)
+        return as_int if as_int == number else float(number)
+    if cell_type == "s":
+        return shared_strings[int(text)]
+    if cell_type == "b":
+        return bool(int(text))
+    if cell_type == "e":
+        return np.nan
+    if cell_type == "d":
+        return pd.Timestamp(text).to_pydatetime()
+    return text
+
+
+def convert_xlsx_date(serial: Any, timedelta: bool, epoch: datetime.datetime) -> Any:
+    # So trong o co dinh dang ngay gio: doi nhu openpyxl; ngoai gioi han ngay thi openpyxl coi la loi -> NaN.
+    try:
+        return from_excel(serial, epoch, timedelta=timedelta)
+    except (OverflowError, ValueError):
+        return np.nan
+
+
+def xlsx_cell_pattern(prefix: str, letters: str = "[A-Z]+") -> re.Pattern:
+    # Nhom: cot, dong, cac thuoc tinh con lai (t, s), noi dung <v> don gian, phan con lai (cong thuc/inlineStr).
+    return re.compile(
+        rf'<{prefix}c r="({letters})(\d+)"([^>]*?)'
+        rf"(?:/>|>(?:<{prefix}v>([^<]*)</{prefix}v>)?(.*?)</{prefix}c>)",
+        re.S,
+    )
+
+
+def xlsx_attribute(attributes: str, name: str) -> Optional[str]:
+    start = attributes.find(f' {name}="')
+    if start < 0:
+        return None
+    start += len(name) + 3
+    return attributes[start:attributes.find('"', start)]
+
+
+def xlsx_match_value(
+    cell: tuple,
+    prefix: str,
+    shared_strings: list[str],
+    date_styles: Optional[Dict[str, bool]] = None,
+    epoch: datetime.datetime = CALENDAR_WINDOWS_1900,
+) -> Any:
+    _, _, attributes, text, inner = cell
+    cell_type = xlsx_attribute(attributes, "t") or "n"
+    if inner or cell_type == "inlineStr":
+        text = xlsx_cell_text(cell_type, inner, prefix)
+    elif text and "&" in text:
+        text = html.unescape(text)
+    value = convert_xlsx_cell(cell_type, text or None, shared_strings)
+    if date_styles and cell_type == "n" and value != "":
+        style = xlsx_attribute(attributes, "s") or "0"
+        if style in date_styles:
+            return convert_xlsx_date(value, date_styles[style], epoch)
+    return value
+
+
+def xlsx_last_row_with_value(text: str, prefix: str) -> int:
+    value_open = f"<{prefix}v>"
+    cell_open = f'<{prefix}c r="'
+    end = len(text)
+    while True:
+        value_at = max(text.rfind(value_open, 0, end), text.rfind(f"<{prefix}is>", 0, end))
+        if value_at < 0:
+            return 0
+        end = value_at
+        if text.startswith(value_open, value_at) and text.startswith("<", value_at + len(value_open)):
+            continue
+        cell_at = text.rfind(cell_open, 0, value_at)
+        if cell_at < 0:
+            return 0
+        ref_start = cell_at + len(cell_open)
+        ref = text[ref_start:text.find('"', ref_start)]
+        return int(ref.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+
+
+def mb52_xlsx_columns(header: list[Any]) -> list[Any]:
+    names = [col for col in REQUIRED_MB52_COLUMNS if col in header]
+    sloc_col = detect_storage_location_column(pd.DataFrame(columns=header))
+    if sloc_col is not None:
+        names.append(sloc_col)
+    return names
+
+
+def read_mb52_xlsx(file_bytes: bytes) -> pd.DataFrame:
+    # Chi doc cac cot MB52 can dung (Material, Plant, Sloc, Unrestricted, WBS) thay vi toan bo workbook.
+    return read_xlsx_columns(file_bytes, mb52_xlsx_columns)
+
+
+def read_xlsx_columns(file_bytes: bytes, select_columns: Callable[[list[Any]], list[Any]]) -> pd.DataFrame:
+    with zipfile.ZipFile(io.BytesIO(file_bytes)) as archive:
+        sheet_path = xlsx_first_sheet_path(archive)
+        shared_strings = read_xlsx_shared_strings(archive)
+        date_styles = read_xlsx_date_styles(archive)
+        epoch = xlsx_epoch(archive)
+
+        prefix = ""
+        header: list[Any] = []
+        names: list[Any] = []
+        cell_pattern = None
+        column_values: Dict[str, list] = {}
+        last_row_with_data = 0
+
+        with archive.open(sheet_path) as xml_source:
+            for text in iter_xlsx_row_chunks(xml_source):
+                if cell_pattern is None:
+                    match = XLSX_SHEET_DATA_PATTERN.search(text)
+                    if match is None:
+                        continue
+                    prefix = match.group(1) or ""
+                    first_row = text[match.end():text.find(f"</{prefix}row>", match.end())]
+                    if first_row.count(f"<{prefix}c ") != first_row.count(f'<{prefix}c r="'):
+                        raise UnsupportedSheetLayout("Ô Excel không bắt đầu bằng tọa độ r.")
+
+                    header_cells = {
+                        column_index_from_string(cell[0]): xlsx_match_value(cell, prefix, shared_strings, date_styles, epoch)
+                        for cell in xlsx_cell_pattern(prefix).findall(first_row)
+                        if cell[1] == "1"
+                    }
+                    header = [header_cells.get(col, "") for col in range(1, max(header_cells, default=0) + 1)]
+                    names = select_columns(header)
+                    column_values = {get_column_letter(header.index(name) + 1): [] for name in names}
+                    cell_pattern = xlsx_cell_pattern(prefix, "|".join(column_values) or "(?!)")
+
+                for cell in cell_pattern.finditer(text):
+                    values = column_values[cell.group(1)]
+                    position = int(cell.group(2)) - 2
+                    if position > len(values):
+                        values.extend([""] * (position - len(values)))
+                    if position == len(values):
+                        values.append(xlsx_match_value(cell.groups(), prefix, shared_strings, date_styles, epoch))
+                last_row_with_data = max(last_row_with_data, xlsx_last_row_with_value(text, prefix))
+
+    if last_row_with_data == 0:
+        return pd.DataFrame()
+
+    # Dung TextParser nhu pd.read_excel de suy kieu du lieu cua tung cot giong het.
+    data_rows = last_row_with_data - 1
+    columns = [values[:data_rows] + [""] * (data_rows - len(values)) for values in column_values.values()]
+    if names:
+        data = [names] + [list(row) for row in zip(*columns)]
+    else:
+        data = [names] + [[] for _ in range(data_rows)]
+    return TextParser(data, header=0, skip_blank_lines=False).read()
+
+
+def mb52_cache_path(digest: str, suffix: str) -> str:
+    return os.path.join(MB52_CACHE_DIR, f"{digest}.v{MB52_CACHE_VERSION}{suffix}")
+
+
+def read_mb52_cache(digest: str) -> Optional[pd.DataFrame]:
+    path = mb52_cache_path(digest, ".parquet")
+    try:
+        df = pd.read_parquet(path)
+        os.utime(path)
+    except (OSError, ImportError, ValueError):
+        return None
+    return df
+
+
+def read_mb52_cache_meta(digest: str) -> Dict[str, str]:
+    try:
+        with open(mb52_cache_path(digest, ".json"), encoding="utf-8") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_mb52_cache(digest: str, df: pd.DataFrame, meta: Optional[Dict[str, str]] = None) -> None:
+    try:
+        os.makedirs(MB52_CACHE_DIR, exist_ok=True)
+        write_file_atomic(mb52_cache_path(digest, ".parquet"), lambda path: df.to_parquet(path, index=False))
+        if meta:
+            def write_meta(path: str) -> None:
+                with open(path, "w", encoding="utf-8") as file:
+                    json.dump(meta, file, ensure_ascii=False, indent=2)
+
+            write_file_atomic(mb52_cache_path(digest, ".json"), write_meta)
+        evict_mb52_cache()
+    except (OSError, ImportError, ValueError):
+        # Cache chi de tang toc; loi ghi cache khong duoc lam hong luong kiem tra.
+        pass
+
+
+def evict_mb52_cache(max_bytes: int = MB52_CACHE_MAX_BYTES) -> None:
+    entries = []
+    for name in os.listdir(MB52_CACHE_DIR):
+        if not name.endswith(".parquet"):
+            continue
+        data_path = os.path.join(MB52_CACHE_DIR, name)
+        meta_path = data_path[: -len(".parquet")] + ".json"
+        size = os.path.getsize(data_path) + (os.path.getsize(meta_path) if os.path.exists(meta_path) else 0)
+        entries.append((os.path.getmtime(data_path), size, data_path, meta_path))
+
+    total = sum(size for _, size, _, _ in entries)
+    for _, size, data_path, meta_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        for path in (data_path, meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        total -= size
+
+
+def load_mb52(file_bytes: bytes, meta: Optional[Dict[str, str]] = None, timer: Optional[StageTimer] = None) -> pd.DataFrame:
+    digest = content_digest(file_bytes)
+    with timed_stage(timer, "mb52_cache_read") as record:
+        cached = read_mb52_cache(digest)
+        record["rows"] = len(cached) if cached is not None else 0
+    if cached is not None:
+        return cached
+
+    with timed_stage(timer, "mb52_parse_xlsx") as record:
+        try:
+            df = read_mb52_xlsx(file_bytes)
+        except (zipfile.BadZipFile, KeyError, ET.ParseError, UnsupportedSheetLayout):
+            df = pd.read_excel(io.BytesIO(file_bytes))
+        record["rows"] = len(df)
+
+    sloc_col = detect_storage_location_column(df)
+    if not sloc_col:
+        raise StockCheckError("Không tìm thấy cột Storage Location trong MB52.")
+    if sloc_col != "Storage Location":
+        df = df.rename(columns={sloc_col: "Storage Location"})
+
+    validate_columns(df, REQUIRED_MB52_COLUMNS + ["Storage Location"], "MB52")
+
+    with timed_stage(timer, "mb52_normalize", len(df)):
+        df["Unrestricted"] = pd.to_numeric(df["Unrestricted"], errors="coerce").fillna(0)
+        df["Material"] = normalize_key_series(df["Material"], strip_leading_zeros=True)
+        df["Plant"] = normalize_key_series(df["Plant"])
+        df["Storage Location"] = normalize_key_series(df["Storage Location"], strip_leading_zeros=True)
+        df["WBS Element"] = normalize_key_series(df["WBS Element"])
+        # Khoa MB52 chi co vai nghin gia tri khac nhau tren hang tram nghin dong: luu dang category (tu dien da sap xep).
+        df = df.astype({col: "category" for col in MB52_KEY_COLUMNS})
+
+    with timed_stage(timer, "mb52_cache_write", len(df)):
+        write_mb52_cache(digest, df, meta)
+    return df
+
+
+def load_issue(file_bytes: bytes) -> pd.DataFrame:
+    df = pd.read_excel(io.BytesIO(file_bytes))
+    validate_columns(df, REQUIRED_ISSUE_COLUMNS, "phiếu xuất kho")
+
+    actual_col = detect_column_by_name_or_position(
+        df,
+        ["Actual Quantity", "Thực xuất"],
+        28,  # AB
+        "Actual Quantity / Thực xuất",
+    )
+    status_col = detect_column_by_name_or_position(
+        df,
+        ["Status"],
+        29,  # AC
+        "Status",
+    )
+
+    if actual_col != "Actual Quantity":
+        df = df.rename(columns={actual_col: "Actual Quantity"})
+    if status_col != "Status":
+        df = df.rename(columns={status_col: "Status"})
+
+    df["Transfer Quantity"] = pd.to_numeric(df["Transfer Quantity"], errors="coerce").fillna(0)
+    df["Actual Quantity"] = pd.to_numeric(df["Actual Quantity"], errors="coerce").fillna(0)
+    df["Status"] = normalize_key_series(df["Status"], strip_leading_zeros=True)
+
+    df["Material Number"] = normalize_key_series(df["Material Number"], strip_leading_zeros=True)
+    df["Plant"] = normalize_key_series(df["Plant"])
+    df["Source WBS"] = normalize_key_series(df["Source WBS"])
+    df["Sending Sloc"] = normalize_key_series(df["Sending Sloc"], strip_leading_zeros=True)
+    df["Functional Location"] = normalize_key_series(df["Functional Location"])
+
+    return df
+
+
+def iq09_xlsx_columns(header: list[Any]) -> list[Any]:
+    names = [col for col in REQUIRED_IQ09_COLUMNS if col in header]
+    sloc_col = detect_storage_location_column(pd.DataFrame(columns=header))
+    if sloc_col is not None:
+        names.append(sloc_col)
+    wbs_col = detect_iq09_wbs_column(header)
+    if wbs_col is not None:
+        names.append(wbs_col)
+    return names
+
+
+def detect_iq09_wbs_column(columns) -> Optional[str]:
+    return next((col for col in columns if normalize_column_name(col) in IQ09_WBS_COLUMN_NAMES), None)
+
+
+def read_local_iq09(path: str) -> Tuple[bytes, str]:
+    with open(path, "rb") as file:
+        content = file.read()
+    return content, content_digest(content)
+
+
+def load_iq09(file_bytes: bytes) -> pd.DataFrame:
+    try:
+        df = read_xlsx_columns(file_bytes, iq09_xlsx_columns)
+    except (zipfile.BadZipFile, KeyError, ET.ParseError, UnsupportedSheetLayout):
+        df = pd.read_excel(io.BytesIO(file_bytes))
+    validate_columns(df, REQUIRED_IQ09_COLUMNS, "IQ09")
+
+    sloc_col = detect_storage_location_column(df)
+    if not sloc_col:
+        raise StockCheckError("Không tìm thấy cột Storage Location trong IQ09.")
+    wbs_col = detect_iq09_wbs_column(df.columns)
+
+    # Cung khoa chuan hoa voi MB52 de tra cuu serial theo dung khoa cua 5 tang.
+    serials = pd.DataFrame(
+        {
+            "Serial": normalize_key_series(df["ManufactSerialNumber"]),
+            "Material": normalize_key_series(df["Material"], strip_leading_zeros=True),
+            "Plant": normalize_key_series(df["Plant"]),
+            "Storage Location": normalize_key_series(df[sloc_col], strip_leading_zeros=True),
+            "WBS Element": normalize_key_series(df[wbs_col]) if wbs_col else "",
+            "User Status": normalize_key_series(df["User Status"]),
+        }
+    )
+    return serials[serials["Serial"] != ""].reset_index(drop=True)
+
+
+COL_LAYER = "\u0054\u1ea7ng \u0111\u00e1p \u1ee9ng"
+COL_SUGGEST_TRANSFER = "G\u1ee3i \u00fd chuy\u1ec3n WBS"
+COL_MISSING_STOCK = "Thi\u1ebfu kho"
+COL_PROCESS_QTY = "S\u1ed1 l\u01b0\u1ee3ng c\u1ea7n x\u1eed l\u00fd"
+COL_SHORTAGE = "C\u00f2n thi\u1ebfu"
+COL_BUSINESS_STATUS = "T\u00ecnh tr\u1ea1ng"
+COL_ACTION = "G\u1ee3i \u00fd x\u1eed l\u00fd"
+COL_OK = "\u0110\u1ea3m b\u1ea3o 100%"
+COL_CHECK_KEY = "Kh\u00f3a ki\u1ec3m tra MB52"
+COL_MATCHED_ROWS = "S\u1ed1 d\u00f2ng MB52 kh\u1edbp"
+COL_DIRECT_STOCK = "T\u1ed3n kho \u0111\u00fang kh\u00f3a MB52"
+COL_SERIAL_AVAILABLE = "Serial khả dụng đúng khóa"
+COL_SERIAL_STATUS = "Tình trạng serial"
+COL_SERIAL_CANDIDATES = "Serial đề xuất"
+SERIAL_COLUMNS = [COL_SERIAL_AVAILABLE, COL_SERIAL_STATUS, COL_SERIAL_CANDIDATES]
+
+STOCK_CHECK_STATUSES = {"1", "5", "9"}
+EXPORTED_STATUS = "12"
+
+
+def join_unique_grouped(values: pd.Series, group_ids: pd.Series, group_count: int, limit: int = 8) -> pd.Series:
+    # Gia tri khac nhau theo thu tu xuat hien trong tung nhom, qua limit thi them ", +k".
+    texts = values.dropna().astype(str).str.strip()
+    distinct = pd.DataFrame({"group": group_ids.loc[texts.index].to_numpy(), "text": texts.to_numpy()})
+    distinct = distinct[distinct["text"] != ""].drop_duplicates()
+
+    counts = distinct.groupby("group").size().reindex(range(group_count), fill_value=0)
+    kept = distinct[distinct.groupby("group").cumcount() < limit]
+    joined = kept.groupby("group")["text"].agg(", ".join).reindex(range(group_count), fill_value="")
+    overflow = counts - limit
+    suffix = (", +" + overflow.astype(str)).where(overflow > 0, "")
+    return (joined + suffix).reset_index(drop=True)
+
+
+MB52_KEY_COLUMNS = ["Material", "Plant", "Storage Location", "WBS Element"]
+ISSUE_KEY_COLUMNS = ["Material Number", "Plant", "Sending Sloc", "Source WBS"]
+ISSUE_TO_MB52_KEYS = dict(zip(ISSUE_KEY_COLUMNS, MB52_KEY_COLUMNS))
+
+# Tang kho -> khoa tong hop Unrestricted trong MB52, theo dung thu tu kiem tra 5 tang.
+STOCK_LAYER_KEYS = {
+    "T\u1ed3n kho DA CN": ["Material", "Plant", "Storage Location", "WBS Element"],
+    "T\u1ed3n kho DA T\u1ec9nh": ["Material", "Plant", "WBS Element"],
+    "T\u1ed3n kho CN": ["Material", "Plant", "Storage Location"],
+    "T\u1ed3n kho T\u1ec9nh": ["Material", "Plant"],
+    "T\u1ed3n kho Khu v\u1ef1c": ["Material"],
+}
+
+STOCK_LAYER_KEY_POSITIONS = {
+    stock_col: [MB52_KEY_COLUMNS.index(col) for col in keys] for stock_col, keys in STOCK_LAYER_KEYS.items()
+}
+
+STOCK_LAYER_LABELS = {
+    "T\u1ed3n kho DA CN": "Kho DA CN",
+    "T\u1ed3n kho DA T\u1ec9nh": "Kho DA T\u1ec9nh",
+    "T\u1ed3n kho CN": "Kho CN",
+    "T\u1ed3n kho T\u1ec9nh": "Kho T\u1ec9nh",
+    "T\u1ed3n kho Khu v\u1ef1c": "Kho Khu v\u1ef1c",
+}
+LAYER_NOT_ENOUGH = "Kh\u00f4ng \u0111\u1ee7 5 t\u1ea7ng"
+SUGGEST_DA_CN = "\u0110\u1ee7 t\u1ed3n kho \u0111\u00fang kho chi nh\u00e1nh v\u00e0 \u0111\u00fang WBS"
+SUGGEST_NOT_ENOUGH = "Thi\u1ebfu to\u00e0n b\u1ed9 c\u00e1c t\u1ea7ng kho"
+
+PENDING_STATUS_OK = "Status 1/5/9 - \u0111\u1ee7 t\u1ed3n kho"
+PENDING_STATUS_SERIAL_SHORT = "Status 1/5/9 - thiếu serial khả dụng"
+PENDING_STATUS_SHORT = "Status 1/5/9 - kh\u00f4ng \u0111\u1ee7 t\u1ed3n kho"
+ACTION_STOCK_OK = "\u0110\u1ee7 t\u1ed3n kho MB52 \u0111\u00fang Material/Plant/Sloc/WBS"
+ACTION_SERIAL_SHORT = "Đủ tồn kho MB52 nhưng thiếu serial IQ09 khả dụng đúng khóa, xem cột Serial đề xuất"
+REPORT_STATUS_OK = "\u0110\u1ea2M B\u1ea2O"
+REPORT_STATUS_NOT_OK = "KH\u00d4NG \u0110\u1ea2M B\u1ea2O"
+
+EXPORTED_CHECK_KEY = "Status = 12, kh\u00f4ng ki\u1ec3m tra MB52"
+EXPORTED_LAYER = "\u0110\u00e3 xu\u1ea5t kho"
+EXPORTED_SUGGEST_TRANSFER = "Status = 12, kh\u00f4ng t\u00ednh t\u1ed3n kho/chuy\u1ec3n kho"
+EXPORTED_STATUS_EQUAL = "Status 12 - \u0111\u00e3 xu\u1ea5t \u0111\u1ee7"
+EXPORTED_STATUS_SHORT = "Status 12 - xu\u1ea5t thi\u1ebfu"
+EXPORTED_STATUS_OVER = "Status 12 - xu\u1ea5t d\u01b0 so v\u1edbi y\u00eau c\u1ea7u"
+EXPORTED_ACTION_EQUAL = "Kh\u00f4ng c\u1ea7n x\u1eed l\u00fd th\u00eam"
+EXPORTED_ACTION_SHORT = "Ki\u1ec3m tra Actual Quantity v\u00e0 xu\u1ea5t b\u1ed5 sung ph\u1ea7n c\u00f2n thi\u1ebfu"
+EXPORTED_ACTION_OVER = "Ki\u1ec3m tra l\u1ea1i Actual Quantity v\u00e0 phi\u1ebfu xu\u1ea5t kho"
+
+
+def mb52_key_codes(mb52_raw: pd.DataFrame) -> Tuple[pd.DataFrame, Dict[str, pd.Index]]:
+    codes = pd.DataFrame(index=mb52_raw.index)
+    vocab: Dict[str, pd.Index] = {}
+    for col in MB52_KEY_COLUMNS:
+        values = mb52_raw[col]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype("category")
+        # Tu dien sap xep de thu tu ma so trung voi thu tu chuoi khi group-by co sort.
+        values = values.cat.reorder_categories(values.cat.categories.sort_values())
+        vocab[col] = values.cat.categories
+        codes[col] = values.cat.codes.astype(np.int32)
+    codes["Unrestricted"] = mb52_raw["Unrestricted"]
+    return codes, vocab
+
+
+def encode_issue_keys(keys_df: pd.DataFrame, vocab: Dict[str, pd.Index]) -> pd.DataFrame:
+    # Ma hoa khoa phieu bang tu dien MB52; gia tri khong co trong MB52 nhan ma -1 va khong khop tang nao.
+    encoded = pd.DataFrame(index=keys_df.index)
+    for issue_col, mb52_col in ISSUE_TO_MB52_KEYS.items():
+        encoded[mb52_col] = vocab[mb52_col].get_indexer(keys_df[issue_col]).astype(np.int32)
+    return encoded
+
+
+def aggregate_stock_layers(codes: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    layers = {}
+    for stock_col, keys in STOCK_LAYER_KEYS.items():
+        aggregations = {stock_col: ("Unrestricted", "sum")}
+        if stock_col == "T\u1ed3n kho DA CN":
+            aggregations[COL_MATCHED_ROWS] = ("Unrestricted", "size")
+        layers[stock_col] = codes.groupby(keys, as_index=False, sort=False).agg(**aggregations)
+    return layers
+
+
+def build_stock_index(mb52_raw: pd.DataFrame) -> Dict[str, Any]:
+    codes, vocab = mb52_key_codes(mb52_raw)
+    stock_index: Dict[str, Any] = {"vocab": vocab}
+    stock_index.update(aggregate_stock_layers(codes))
+    stock_index["sources"] = build_transfer_sources(codes, vocab)
+    stock_index["fingerprints"] = material_fingerprints(mb52_raw)
+    return stock_index
+
+
+def lookup_stock_layers(keys_df: pd.DataFrame, stock_index: Dict[str, Any]) -> pd.DataFrame:
+    result = encode_issue_keys(keys_df, stock_index["vocab"])
+    for stock_col, keys in STOCK_LAYER_KEYS.items():
+        result = result.merge(stock_index[stock_col], on=keys, how="left", sort=False)
+        result[stock_col] = result[stock_col].fillna(0).astype(float)
+    result[COL_MATCHED_ROWS] = result[COL_MATCHED_ROWS].fillna(0).astype(int)
+    result.index = keys_df.index
+    return result
+
+
+def build_transfer_sources(codes: pd.DataFrame, vocab: Dict[str, pd.Index]) -> Dict[str, Dict[Any, list]]:
+    positive = codes.loc[codes["Unrestricted"] > 0]
+    grouped = positive.groupby(MB52_KEY_COLUMNS, as_index=False)["Unrestricted"].sum()
+    for col in MB52_KEY_COLUMNS:
+        grouped[col] = vocab[col].take(grouped[col].to_numpy())
+
+    # Nguon chuyen kho (Plant, Sloc, WBS, Unrestricted) theo thu tu khoa, tra cuu theo khoa cua tung tang.
+    sources: Dict[str, Dict[Any, list]] = {"material": {}, "plant": {}, "sloc": {}, "wbs": {}}
+    for mat, plant, sloc, wbs, qty in grouped.itertuples(index=False, name=None):
+        source = (plant, sloc, wbs, qty)
+        sources["material"].setdefault(mat, []).append(source)
+        sources["plant"].setdefault((mat, plant), []).append(source)
+        sources["sloc"].setdefault((mat, plant, sloc), []).append(source)
+        sources["wbs"].setdefault((mat, plant, wbs), []).append(source)
+    return sources
+
+
+def material_fingerprints(mb52_raw: pd.DataFrame) -> pd.DataFrame:
+    # Bam tung dong (Plant, Sloc, WBS, Unrestricted, vi tri trong Material) roi XOR theo Material:
+    # Material giu nguyen tap dong va thu tu dong thi giu nguyen dau van tay.
+    material_codes, materials = pd.factorize(mb52_raw["Material"])
+    rows = mb52_raw[["Plant", "Storage Location", "WBS Element", "Unrestricted"]].copy()
+    rows["position"] = pd.Series(material_codes, index=mb52_raw.index).groupby(material_codes).cumcount()
+    hashed = pd.util.hash_pandas_object(rows, index=False).to_numpy()
+
+    order = np.argsort(material_codes, kind="stable")
+    sorted_codes = material_codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(order) else np.array([], dtype=int)
+    return pd.DataFrame(
+        {
+            "rows": np.diff(np.r_[starts, len(order)]),
+            "hash": np.bitwise_xor.reduceat(hashed[order], starts) if len(order) else np.array([], dtype=np.uint64),
+        },
+        index=pd.Index(np.asarray(materials)[sorted_codes[starts]], name="Material"),
+    )
+
+
+def diff_material_fingerprints(previous: pd.DataFrame, current: pd.DataFrame) -> pd.Index:
+    common = previous.index.intersection(current.index)
+    same = (previous.loc[common, "rows"].to_numpy() == current.loc[common, "rows"].to_numpy()) & (
+        previous.loc[common, "hash"].to_numpy() == current.loc[common, "hash"].to_numpy()
+    )
+    return previous.index.symmetric_difference(current.index).append(common[~same])
+
+
+def update_stock_index(stock_index: Dict[str, Any], mb52_raw: pd.DataFrame, changed: pd.Index) -> Dict[str, Any]:
+    # Chi tong hop lai cac dong MB52 cua Material thay doi; khoa cua Material khac giu nguyen tu chi muc cu.
+    subset = mb52_raw.loc[mb52_raw["Material"].isin(changed)]
+    vocab: Dict[str, pd.Index] = {}
+    codes = pd.DataFrame(index=subset.index)
+    remap = {}
+    for col in MB52_KEY_COLUMNS:
+        values = subset[col].astype(str)
+        vocab[col] = stock_index["vocab"][col]
+        added = pd.Index(values.unique()).difference(vocab[col])
+        if len(added):
+            # Tu dien luon sap xep: gia tri moi chen vao giua thi doi ma so cua cac gia tri cu.
+            merged = vocab[col].append(added).sort_values()
+            remap[col] = merged.get_indexer(vocab[col]).astype(np.int32)
+            vocab[col] = merged
+        codes[col] = vocab[col].get_indexer(values).astype(np.int32)
+    codes["Unrestricted"] = subset["Unrestricted"]
+
+    changed_codes = vocab["Material"].get_indexer(changed)
+    updated: Dict[str, Any] = {"vocab": vocab}
+    for stock_col, layer_df in aggregate_stock_layers(codes).items():
+        previous = stock_index[stock_col]
+        if remap:
+            previous = previous.assign(
+                **{col: remap[col][previous[col].to_numpy()] for col in STOCK_LAYER_KEYS[stock_col] if col in remap}
+            )
+        previous = previous.loc[~previous["Material"].isin(changed_codes)]
+        updated[stock_col] = pd.concat([previous, layer_df], ignore_index=True)
+
+    # Danh sach nguon theo Material cho biet moi khoa plant/sloc/wbs cu can bo.
+    sources = {name: dict(entries) for name, entries in stock_index["sources"].items()}
+    for mat in changed:
+        for plant, sloc, wbs, _ in sources["material"].pop(mat, []):
+            sources["plant"].pop((mat, plant), None)
+            sources["sloc"].pop((mat, plant, sloc), None)
+            sources["wbs"].pop((mat, plant, wbs), None)
+    for name, entries in build_transfer_sources(codes, vocab).items():
+        sources[name].update(entries)
+    updated["sources"] = sources
+    return updated
+
+
+# Qua nguong nay thi dung lai chi muc tu dau nhanh hon cap nhat tung Material.
+INCREMENTAL_MAX_CHANGED_SHARE = 0.5
+
+
+def refresh_stock_index(previous_index: Dict[str, Any], mb52_raw: pd.DataFrame) -> Tuple[Dict[str, Any], pd.Index]:
+    fingerprints = material_fingerprints(mb52_raw)
+    changed = diff_material_fingerprints(previous_index["fingerprints"], fingerprints)
+    if len(changed) > INCREMENTAL_MAX_CHANGED_SHARE * max(len(fingerprints), 1):
+        return build_stock_index(mb52_raw), changed
+    stock_index = update_stock_index(previous_index, mb52_raw, changed)
+    stock_index["fingerprints"] = fingerprints
+    return stock_index, changed
+
+
+def rank_sources(candidates: list) -> list:
+    # Cung thu tu voi sort_values("Unrestricted", ascending=False) de noi dung goi y khong doi.
+    qty = np.fromiter((source[3] for source in candidates), dtype=float, count=len(candidates))
+    order = np.arange(len(qty))[::-1][qty[::-1].argsort(kind="quicksort")][::-1]
+    return [candidates[i] for i in order]
+
+
+def source_summary(candidates: list, exclude: Optional[Callable[[str, str, str], bool]] = None, limit: int = 3) -> str:
+    if exclude is not None:
+        candidates = [source for source in candidates if not exclude(*source[:3])]
+    if not candidates:
+        return ""
+    parts = []
+    for plant, sloc, wbs, qty in rank_sources(candidates)[:limit]:
+        parts.append(f"Plant {plant} / Sloc {sloc} / WBS {wbs} ({float(qty):,.2f})")
+    return "; ".join(parts)
+
+
+TRANSFER_SUGGESTION_PREFIXES = {
+    "Kho DA T\u1ec9nh": "C\u00f3 th\u1ec3 chuy\u1ec3n kho chi nh\u00e1nh trong c\u00f9ng WBS t\u1eeb ",
+    "Kho CN": "C\u00f3 th\u1ec3 chuy\u1ec3n d\u1ef1 \u00e1n/WBS t\u1ea1i c\u00f9ng kho chi nh\u00e1nh t\u1eeb ",
+    "Kho T\u1ec9nh": "C\u00f3 th\u1ec3 chuy\u1ec3n kho/chuy\u1ec3n d\u1ef1 \u00e1n trong c\u00f9ng Plant t\u1eeb ",
+    "Kho Khu v\u1ef1c": "C\u00f3 th\u1ec3 \u0111i\u1ec1u chuy\u1ec3n li\u00ean Plant/khu v\u1ef1c t\u1eeb ",
+}
+
+
+def transfer_suggestion(
+    transfer_sources: Dict[str, Dict[Any, list]],
+    layer: str,
+    mat: str,
+    plant: str,
+    sloc: str,
+    wbs: str,
+) -> str:
+    if layer == "Kho DA CN":
+        return SUGGEST_DA_CN
+    if layer == LAYER_NOT_ENOUGH:
+        return SUGGEST_NOT_ENOUGH
+
+    if layer == "Kho DA T\u1ec9nh":
+        candidates = transfer_sources["wbs"].get((mat, plant, wbs), [])
+        exclude = lambda p, s, w: s == sloc
+    elif layer == "Kho CN":
+        candidates = transfer_sources["sloc"].get((mat, plant, sloc), [])
+        exclude = lambda p, s, w: w == wbs
+    elif layer == "Kho T\u1ec9nh":
+        candidates = transfer_sources["plant"].get((mat, plant), [])
+        exclude = lambda p, s, w: s == sloc and w == wbs
+    else:
+        candidates = transfer_sources["material"].get(mat, [])
+        exclude = lambda p, s, w: p == plant
+
+    sources = source_summary(candidates, exclude)
+    if not sources:
+        sources = source_summary(candidates)
+    return TRANSFER_SUGGESTION_PREFIXES[layer] + sources
+
+
+COL_ALLOCATION_ORDER = "Thứ tự phân bổ"
+COL_ALLOCATED = "Số lượng phân bổ"
+COL_ALLOCATION_SOURCES = "Nguồn phân bổ"
+ALLOCATION_COLUMNS = [COL_ALLOCATION_ORDER, COL_ALLOCATED, COL_ALLOCATION_SOURCES]
+ALLOCATION_ORDERS = {
+    "fifo": "FIFO theo Request Number",
+    "qty_asc": "Số lượng nhỏ trước",
+    "qty_desc": "Số lượng lớn trước",
+}
+
+# Thu tu lay ton kho khi dong duoc dap ung o tung tang: luon lay dung khoa truoc, roi den cac tang nho hon.
+ALLOCATION_STEPS = {
+    "T\u1ed3n kho DA CN": ["T\u1ed3n kho DA CN"],
+    "T\u1ed3n kho DA T\u1ec9nh": ["T\u1ed3n kho DA CN", "T\u1ed3n kho DA T\u1ec9nh"],
+    "T\u1ed3n kho CN": ["T\u1ed3n kho DA CN", "T\u1ed3n kho CN"],
+    "T\u1ed3n kho T\u1ec9nh": ["T\u1ed3n kho DA CN", "T\u1ed3n kho DA T\u1ec9nh", "T\u1ed3n kho CN", "T\u1ed3n kho T\u1ec9nh"],
+    "T\u1ed3n kho Khu v\u1ef1c": list(STOCK_LAYER_KEYS),
+}
+
+
+class StockAllocator:
+    # Tru dan ton kho theo tung dong da phan bo. Moi khoa tang co mot heap nguon (con nhieu truoc),
+    # nguon da bi dong truoc lay bot duoc cap nhat luc lay ra (lazy) thay vi quet lai MB52.
+    def __init__(self, stock_index: Dict[str, Any]):
+        self.sources = stock_index["sources"]
+        self.remaining: Dict[tuple, float] = {}
+        self.consumed: Dict[str, Dict[tuple, float]] = {stock_col: {} for stock_col in STOCK_LAYER_KEYS}
+        self.heaps: Dict[Tuple[str, tuple], list] = {}
+
+    def layer_key(self, stock_col: str, bucket: tuple) -> tuple:
+        return tuple(bucket[pos] for pos in STOCK_LAYER_KEY_POSITIONS[stock_col])
+
+    def layer_candidates(self, stock_col: str, bucket: tuple) -> list:
+        mat, plant, sloc, wbs = bucket
+        if stock_col == "T\u1ed3n kho DA CN":
+            return [source for source in self.sources["sloc"].get((mat, plant, sloc), []) if source[2] == wbs]
+        if stock_col == "T\u1ed3n kho DA T\u1ec9nh":
+            return self.sources["wbs"].get((mat, plant, wbs), [])
+        if stock_col == "T\u1ed3n kho CN":
+            return self.sources["sloc"].get((mat, plant, sloc), [])
+        if stock_col == "T\u1ed3n kho T\u1ec9nh":
+            return self.sources["plant"].get((mat, plant), [])
+        return self.sources["material"].get(mat, [])
+
+    def heap(self, stock_col: str, bucket: tuple) -> list:
+        heap_key = (stock_col, self.layer_key(stock_col, bucket))
+        heap = self.heaps.get(heap_key)
+        if heap is None:
+            heap = []
+            for order, (plant, sloc, wbs, qty) in enumerate(self.layer_candidates(stock_col, bucket)):
+                source = (bucket[0], plant, sloc, wbs)
+                left = self.remaining.setdefault(source, float(qty))
+                if left > 0:
+                    heap.append((-left, order, source))
+            heapq.heapify(heap)
+            self.heaps[heap_key] = heap
+        return heap
+
+    def available(self, bucket: tuple, stocks: Dict[str, float]) -> Dict[str, float]:
+        return {
+            stock_col: stock - self.consumed[stock_col].get(self.layer_key(stock_col, bucket), 0.0)
+            for stock_col, stock in stocks.items()
+        }
+
+    def consume(self, source: tuple, qty: float) -> None:
+        self.remaining[source] -= qty
+        for stock_col, consumed in self.consumed.items():
+            key = self.layer_key(stock_col, source)
+            consumed[key] = consumed.get(key, 0.0) + qty
+
+    def take(self, stock_col: str, bucket: tuple, need: float, taken: Dict[tuple, float]) -> float:
+        heap = self.heap(stock_col, bucket)
+        while need > 1e-9 and heap:
+            neg_left, order, source = heap[0]
+            left = self.remaining[source]
+            if left <= 1e-9:
+                heapq.heappop(heap)
+                continue
+            if left < -neg_left:
+                heapq.heapreplace(heap, (-left, order, source))
+                continue
+            qty = min(left, need)
+            self.consume(source, qty)
+            taken[source] = taken.get(source, 0.0) + qty
+            need -= qty
+        return need
+
+    def allocate(self, bucket: tuple, qty: float, stocks: Dict[str, float]) -> Tuple[Dict[str, float], Dict[tuple, float]]:
+        # Dong chi nhan ton kho khi mot tang du dap ung ca dong, khong giu cho phan le cua dong thieu.
+        available = self.available(bucket, stocks)
+        layer_col = next((stock_col for stock_col in STOCK_LAYER_KEYS if qty <= available[stock_col]), None)
+        taken: Dict[tuple, float] = {}
+        if layer_col is None:
+            return available, taken
+        need = qty
+        for stock_col in ALLOCATION_STEPS[layer_col]:
+            need = self.take(stock_col, bucket, need, taken)
+            if need <= 1e-9:
+                break
+        return available, taken
+
+
+def allocation_sequence(
+    pending: pd.DataFrame,
+    group_ids: pd.Series,
+    grouped: pd.DataFrame,
+    allocation: str,
+) -> np.ndarray:
+    if allocation not in ALLOCATION_ORDERS:
+        raise StockCheckError(f"Thứ tự phân bổ không hợp lệ: {allocation}")
+    # FIFO: Request Number dang so thi so sanh theo so, con lai theo chuoi; nhom lay dong som nhat.
+    request = pending["Request Number"]
+    lines = pd.DataFrame(
+        {"number": pd.to_numeric(request, errors="coerce").to_numpy(), "text": request.astype(str).to_numpy()}
+    )
+    line_rank = np.empty(len(lines), dtype=np.int64)
+    line_rank[lines.sort_values(["number", "text"], kind="stable").index.to_numpy()] = np.arange(len(lines))
+    group_rank = pd.Series(line_rank).groupby(group_ids.to_numpy()).min().reindex(range(len(grouped))).to_numpy()
+
+    if allocation == "fifo":
+        return np.argsort(group_rank, kind="stable")
+    qty = grouped["Transfer Quantity"].to_numpy(dtype=float)
+    return np.lexsort((group_rank, qty if allocation == "qty_asc" else -qty))
+
+
+def allocate_stock_layers(
+    grouped: pd.DataFrame,
+    layers: pd.DataFrame,
+    sequence: np.ndarray,
+    stock_index: Dict[str, Any],
+) -> pd.DataFrame:
+    allocator = StockAllocator(stock_index)
+    row_count = len(grouped)
+    keys = grouped[ISSUE_KEY_COLUMNS].to_numpy(dtype=object)
+    qty = grouped["Transfer Quantity"].to_numpy(dtype=float)
+    stocks = {stock_col: layers[stock_col].to_numpy(dtype=float) for stock_col in STOCK_LAYER_KEYS}
+
+    available = {stock_col: np.zeros(row_count) for stock_col in STOCK_LAYER_KEYS}
+    order = np.zeros(row_count, dtype=np.int64)
+    allocated = np.zeros(row_count)
+    sources = [""] * row_count
+    for position, row in enumerate(sequence, 1):
+        bucket = tuple(keys[row])
+        row_available, taken = allocator.allocate(
+            bucket, qty[row], {stock_col: values[row] for stock_col, values in stocks.items()}
+        )
+        for stock_col, value in row_available.items():
+            available[stock_col][row] = value
+        order[row] = position
+        allocated[row] = sum(taken.values())
+        sources[row] = "; ".join(
+            f"Plant {plant} / Sloc {sloc} / WBS {wbs} ({float(taken_qty):,.2f})"
+            for (_, plant, sloc, wbs), taken_qty in taken.items()
+            if (plant, sloc, wbs) != bucket[1:]
+        )
+
+    result = pd.DataFrame(available, index=grouped.index)
+    result[COL_ALLOCATION_ORDER] = order
+    result[COL_ALLOCATED] = allocated
+    result[COL_ALLOCATION_SOURCES] = sources
+    return result
+
+
+SERIAL_NOT_MANAGED = "Không quản lý serial"
+SERIAL_ENOUGH = "Đủ serial khả dụng"
+SERIAL_EXPORTED = "Status = 12, không kiểm tra serial"
+
+
+def build_serial_index(iq09_df: pd.DataFrame) -> Dict[str, Any]:
+    # Lap mot lan cho moi snapshot IQ09: serial kha dung theo dung khoa Material/Plant/Sloc/WBS cua MB52.
+    usable = iq09_df[iq09_df["User Status"].isin(IQ09_USABLE_STATUSES)]
+    grouped = usable.groupby(MB52_KEY_COLUMNS, sort=True)["Serial"].agg(list)
+    serials = dict(zip(grouped.index, grouped.to_numpy()))
+
+    by_material: Dict[str, list] = {}
+    for (mat, plant, sloc, wbs), values in serials.items():
+        by_material.setdefault(mat, []).append((plant, sloc, wbs, values))
+    return {
+        "materials": frozenset(iq09_df["Material"]),
+        "serials": serials,
+        "by_material": by_material,
+        "usable_count": len(usable),
+    }
+
+
+def serial_list_text(serials: list, limit: int) -> str:
+    shown = serials[:limit]
+    text = ", ".join(shown)
+    if len(serials) > len(shown):
+        text += f", +{len(serials) - len(shown)}"
+    return text
+
+
+def serial_source_rank(source: tuple, plant: str, sloc: str, wbs: str) -> tuple:
+    # Uu tien nguon gan nhat theo thu tu 5 tang, cung tang thi nhieu serial truoc.
+    src_plant, src_sloc, src_wbs, values = source
+    if src_plant == plant and src_wbs == wbs:
+        layer = 0
+    elif src_plant == plant and src_sloc == sloc:
+        layer = 1
+    elif src_plant == plant:
+        layer = 2
+    else:
+        layer = 3
+    return layer, -len(values)
+
+
+def serial_transfer_text(
+    serial_index: Dict[str, Any],
+    key: tuple,
+    missing: int,
+    limit: int = 3,
+    serial_limit: int = 5,
+) -> str:
+    mat, plant, sloc, wbs = key
+    candidates = [
+        source for source in serial_index["by_material"].get(mat, [])
+        if source[:3] != (plant, sloc, wbs)
+    ]
+    if not candidates:
+        return ""
+    candidates.sort(key=lambda source: serial_source_rank(source, plant, sloc, wbs))
+    parts = []
+    for src_plant, src_sloc, src_wbs, values in candidates[:limit]:
+        parts.append(
+            f"Plant {src_plant} / Sloc {src_sloc} / WBS {src_wbs}: "
+            f"{serial_list_text(values, min(missing, serial_limit))}"
+        )
+    return "; ".join(parts)
+
+
+def lookup_serials(
+    keys_df: pd.DataFrame,
+    qty: pd.Series,
+    serial_index: Dict[str, Any],
+    serial_limit: int = 5,
+) -> Tuple[pd.DataFrame, pd.Series]:
+    available, status, candidates, short = [], [], [], []
+    keys = zip(*(keys_df[col] for col in ISSUE_KEY_COLUMNS))
+    for key, need in zip(keys, qty):
+        if key[0] not in serial_index["materials"]:
+            available.append(0)
+            status.append(SERIAL_NOT_MANAGED)
+            candidates.append("")
+            short.append(False)
+            continue
+
+        exact = serial_index["serials"].get(key, [])
+        need = int(np.ceil(need))
+        available.append(len(exact))
+        if len(exact) >= need:
+            status.append(SERIAL_ENOUGH)
+            candidates.append(serial_list_text(exact, min(need, serial_limit)))
+            short.append(False)
+            continue
+
+        status.append(f"Thiếu serial khả dụng ({len(exact)}/{need})")
+        parts = [serial_list_text(exact, serial_limit)] if exact else []
+        transfer = serial_transfer_text(serial_index, key, need - len(exact), serial_limit=serial_limit)
+        if transfer:
+            parts.append("Chuyển serial từ " + transfer)
+        candidates.append("; ".join(parts))
+        short.append(True)
+
+    serial_df = pd.DataFrame(
+        {
+            COL_SERIAL_AVAILABLE: available,
+            COL_SERIAL_STATUS: status,
+            COL_SERIAL_CANDIDATES: candidates,
+        },
+        index=keys_df.index,
+    )
+    return serial_df, pd.Series(short, index=keys_df.index, dtype=bool)
+
+
+def build_pending_stock_report(
+    issue_df: pd.DataFrame,
+    mb52_raw: pd.DataFrame,
+    stock_index: Optional[Dict[str, Any]] = None,
+    serial_index: Optional[Dict[str, Any]] = None,
+    allocation: Optional[str] = None,
+) -> pd.DataFrame:
+    pending = issue_df[issue_df["Status"].isin(STOCK_CHECK_STATUSES)].copy()
+    if pending.empty:
+        return pd.DataFrame()
+    if stock_index is None:
+        stock_index = build_stock_index(mb52_raw)
+
+    groups = pending.groupby(ISSUE_KEY_COLUMNS)
+    grouped = groups.agg(
+        **{
+            "Material Description": ("Material Description", "first"),
+            "Transfer Quantity": ("Transfer Quantity", "sum"),
+            "Actual Quantity": ("Actual Quantity", "sum"),
+        }
+    ).reset_index()
+    group_ids = groups.ngroup()
+    for col in ["Request Number", "Functional Location", "Status"]:
+        grouped[col] = join_unique_grouped(pending[col], group_ids, len(grouped))
+
+    layers = lookup_stock_layers(grouped, stock_index)
+    if allocation is not None:
+        # Che do phan bo: moi dong chi thay phan ton kho con lai sau cac dong xep truoc no.
+        sequence = allocation_sequence(pending, group_ids, grouped, allocation)
+        allocation_df = allocate_stock_layers(grouped, layers, sequence, stock_index)
+        for stock_col in STOCK_LAYER_KEYS:
+            layers[stock_col] = allocation_df[stock_col]
+    qty = grouped["Transfer Quantity"].astype(float)
+    direct_stock = layers["T\u1ed3n kho DA CN"]
+    stock_ok = qty <= direct_stock
+    serial_short = pd.Series(False, index=grouped.index)
+    if serial_index is not None:
+        serial_df, serial_short = lookup_serials(grouped, qty, serial_index)
+    is_ok = stock_ok & ~serial_short
+
+    layer = pd.Series(
+        np.select(
+            [qty <= layers[stock_col] for stock_col in STOCK_LAYER_KEYS],
+            list(STOCK_LAYER_LABELS.values()),
+            default=LAYER_NOT_ENOUGH,
+        ),
+        index=grouped.index,
+    )
+    suggestion = pd.Series(SUGGEST_NOT_ENOUGH, index=grouped.index)
+    suggestion[layer == "Kho DA CN"] = SUGGEST_DA_CN
+    transfer_rows = grouped.index[~layer.isin(["Kho DA CN", LAYER_NOT_ENOUGH])]
+    for idx in transfer_rows:
+        if allocation is not None:
+            suggestion[idx] = TRANSFER_SUGGESTION_PREFIXES[layer[idx]] + allocation_df.at[idx, COL_ALLOCATION_SOURCES]
+            continue
+        suggestion[idx] = transfer_suggestion(
+            stock_index["sources"],
+            layer[idx],
+            grouped.at[idx, "Material Number"],
+            grouped.at[idx, "Plant"],
+            grouped.at[idx, "Sending Sloc"],
+            grouped.at[idx, "Source WBS"],
+        )
+
+    report = pd.DataFrame(
+        {
+            "Request Number": grouped["Request Number"],
+            "Material Number": grouped["Material Number"],
+            "Material Description": grouped["Material Description"],
+            "Plant": grouped["Plant"],
+            "Source WBS": grouped["Source WBS"],
+            "Sending Sloc": grouped["Sending Sloc"],
+            "Functional Location": grouped["Functional Location"],
+            "Transfer Quantity": qty,
+            "Actual Quantity": grouped["Actual Quantity"].astype(float),
+            "Status": grouped["Status"],
+            COL_CHECK_KEY: (
+                "Material=" + grouped["Material Number"]
+                + " | Plant=" + grouped["Plant"]
+                + " | Sloc=" + grouped["Sending Sloc"]
+                + " | WBS=" + grouped["Source WBS"]
+            ),
+            COL_MATCHED_ROWS: layers[COL_MATCHED_ROWS],
+            COL_DIRECT_STOCK: direct_stock,
+            COL_PROCESS_QTY: qty,
+            COL_SHORTAGE: (qty - direct_stock).clip(lower=0),
+            COL_BUSINESS_STATUS: np.select(
+                [is_ok, stock_ok],
+                [PENDING_STATUS_OK, PENDING_STATUS_SERIAL_SHORT],
+                default=PENDING_STATUS_SHORT,
+            ),
+            COL_ACTION: suggestion.where(~stock_ok, ACTION_STOCK_OK).mask(serial_short & stock_ok, ACTION_SERIAL_SHORT),
+            COL_LAYER: layer,
+            COL_SUGGEST_TRANSFER: suggestion,
+            "Report Status": np.where(is_ok, REPORT_STATUS_OK, REPORT_STATUS_NOT_OK),
+            COL_MISSING_STOCK: ~stock_ok,
+            COL_OK: is_ok,
+        }
+    )
+    for stock_col in STOCK_COLUMNS:
+        report[stock_col] = layers[stock_col]
+    if allocation is not None:
+        for col in ALLOCATION_COLUMNS:
+            report[col] = allocation_df[col]
+    if serial_index is not None:
+        for col in SERIAL_COLUMNS:
+            report[col] = serial_df[col]
+    return report
+
+
+def build_exported_status_report(issue_df: pd.DataFrame) -> pd.DataFrame:
+    # infer_objects: cot object duoc suy kieu lai giong nhu khi dung DataFrame tu danh sach dong.
+    exported = issue_df[issue_df["Status"] == EXPORTED_STATUS].reset_index(drop=True).infer_objects()
+    if exported.empty:
+        return pd.DataFrame()
+
+    transfer_qty = exported["Transfer Quantity"].astype(float)
+    actual_qty = exported["Actual Quantity"].astype(float)
+    difference = transfer_qty - actual_qty
+    is_equal = difference.abs() < 1e-9
+    is_short = ~is_equal & (actual_qty < transfer_qty)
+    shortage = difference.mask(difference < 0, 0.0)
+
+    status_text = np.select([is_equal, is_short], [EXPORTED_STATUS_EQUAL, EXPORTED_STATUS_SHORT], default=EXPORTED_STATUS_OVER)
+    action = np.select([is_equal, is_short], [EXPORTED_ACTION_EQUAL, EXPORTED_ACTION_SHORT], default=EXPORTED_ACTION_OVER)
+
+    report = pd.DataFrame(
+        {
+            "Request Number": exported["Request Number"],
+            "Material Number": normalize_key_series(exported["Material Number"], strip_leading_zeros=True),
+            "Material Description": exported["Material Description"],
+            "Plant": normalize_key_series(exported["Plant"]),
+            "Source WBS": normalize_key_series(exported["Source WBS"]),
+            "Sending Sloc": normalize_key_series(exported["Sending Sloc"], strip_leading_zeros=True),
+            "Functional Location": normalize_key_series(exported["Functional Location"]),
+            "Transfer Quantity": transfer_qty,
+            "Actual Quantity": actual_qty,
+            "Status": exported["Status"],
+            COL_CHECK_KEY: EXPORTED_CHECK_KEY,
+            COL_MATCHED_ROWS: 0,
+            COL_DIRECT_STOCK: 0.0,
+            COL_PROCESS_QTY: shortage,
+            COL_SHORTAGE: shortage,
+            COL_BUSINESS_STATUS: status_text,
+            COL_ACTION: action,
+            COL_LAYER: EXPORTED_LAYER,
+            COL_SUGGEST_TRANSFER: EXPORTED_SUGGEST_TRANSFER,
+            "Report Status": np.where(is_equal, REPORT_STATUS_OK, REPORT_STATUS_NOT_OK),
+            COL_MISSING_STOCK: False,
+            COL_OK: is_equal,
+        }
+    )
+    for stock_col in STOCK_COLUMNS:
+        report[stock_col] = 0.0
+    return report
+
+
+def build_sequential_5_layer(
+    issue_df: pd.DataFrame,
+    mb52_raw: pd.DataFrame,
+    stock_index: Optional[Dict[str, Any]] = None,
+    timer: Optional[StageTimer] = None,
+    serial_index: Optional[Dict[str, Any]] = None,
+    allocation: Optional[str] = None,
+) -> pd.DataFrame:
+    with timed_stage(timer, "pending_5_layer") as record:
+        pending_report = build_pending_stock_report(issue_df, mb52_raw, stock_index, serial_index, allocation)
+        record["rows"] = len(pending_report)
+    with timed_stage(timer, "exported_status_12") as record:
+        exported_report = build_exported_status_report(issue_df)
+        record["rows"] = len(exported_report)
+    if serial_index is not None and not exported_report.empty:
+        exported_report[COL_SERIAL_AVAILABLE] = 0
+        exported_report[COL_SERIAL_STATUS] = SERIAL_EXPORTED
+        exported_report[COL_SERIAL_CANDIDATES] = ""
+    if allocation is not None and not exported_report.empty:
+        exported_report[COL_ALLOCATION_ORDER] = 0
+        exported_report[COL_ALLOCATED] = 0.0
+        exported_report[COL_ALLOCATION_SOURCES] = ""
+    reports = [df for df in [pending_report, exported_report] if not df.empty]
+    if not reports:
+        return pd.DataFrame(columns=STOCK_DETAIL_COLUMNS + [COL_OK])
+    return pd.concat(reports, ignore_index=True, sort=False)
+
+
+def build_business_conclusion(report_df: pd.DataFrame) -> pd.DataFrame:
+    return report_df.copy()
+
+
+def build_conclusion_sheet(total: int, ok: int, not_ok: int, mb52_meta: Dict[str, str]) -> pd.DataFrame:
+    ok_rate = (ok / total * 100) if total else 0
+    conclusion = (
+        "ĐẢM BẢO XUẤT KHO 100%"
+        if total > 0 and not_ok == 0
+        else "CHƯA ĐẢM BẢO XUẤT KHO 100%"
+    )
+    return pd.DataFrame(
+        [
+            {"Thông tin": "Kết luận", "Giá trị": conclusion},
+            {"Thông tin": "Tổng dòng", "Giá trị": total},
+            {"Thông tin": "Đã xuất đủ", "Giá trị": ok},
+            {"Thông tin": "Chưa đảm bảo", "Giá trị": not_ok},
+            {"Thông tin": "Tỷ lệ đảm bảo", "Giá trị": f"{ok_rate:.1f}%"},
+            {"Thông tin": "Nguồn MB52", "Giá trị": mb52_meta.get("source", "")},
+            {"Thông tin": "MB52 URL/Path", "Giá trị": mb52_meta.get("url", "")},
+            {"Thông tin": "Thời điểm kiểm tra", "Giá trị": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S")},
+        ]
+    )
+
+
+def build_stock_summaries(report_df: pd.DataFrame):
+    missing_stock_df = report_df[report_df["Thiếu kho"]].copy()
+
+    if missing_stock_df.empty:
+        empty_fl = pd.DataFrame(columns=["Functional Location", "Số dòng thiếu kho"])
+        empty_material = pd.DataFrame(columns=["Material Number", "Material Description", "Số dòng thiếu kho", "Tổng SL yêu cầu"])
+        empty_plant = pd.DataFrame(columns=["Plant", "Số dòng thiếu kho", "Tổng SL yêu cầu"])
+        empty_suggestion = pd.DataFrame(columns=[
+            "Request Number",
+            "Material Number",
+            "Material Description",
+            "Plant",
+            "Source WBS",
+            "Sending Sloc",
+            "Functional Location",
+            "Transfer Quantity",
+            "Gợi ý chuyển WBS",
+        ])
+        return empty_fl, empty_material, empty_plant, empty_suggestion
+
+    summary_fl = (
+        missing_stock_df.groupby("Functional Location")
+        .size()
+        .reset_index(name="Số dòng thiếu kho")
+        .sort_values("Số dòng thiếu kho", ascending=False)
+    )
+
+    summary_material = (
+        missing_stock_df.groupby(["Material Number", "Material Description"])
+        .agg(
+            **{
+                "Số dòng thiếu kho": ("Material Number", "size"),
+                "Tổng SL yêu cầu": ("Transfer Quantity", "sum"),
+            }
+        )
+        .reset_index()
+        .sort_values("Số dòng thiếu kho", ascending=False)
+    )
+
+    summary_plant = (
+        missing_stock_df.groupby("Plant")
+        .agg(
+            **{
+                "Số dòng thiếu kho": ("Plant", "size"),
+                "Tổng SL yêu cầu": ("Transfer Quantity", "sum"),
+            }
+        )
+        .reset_index()
+        .sort_values("Số dòng thiếu kho", ascending=False)
+    )
+
+    suggestion = missing_stock_df[
+        [
+            "Request Number",
+            "Material Number",
+            "Material Description",
+            "Plant",
+            "Source WBS",
+            "Sending Sloc",
+            "Functional Location",
+            "Transfer Quantity",
+            "Gợi ý chuyển WBS",
+        ]
+    ].copy()
+
+    return summary_fl, summary_material, summary_plant, suggestion
+
+
+TRANSFER_PLAN_COLUMNS = [
+    "Request Number",
+    "Material Number",
+    "Material Description",
+    "Functional Location",
+    "Từ Plant",
+    "Từ Sloc",
+    "Từ WBS",
+    "Đến Plant",
+    "Đến Sloc",
+    "Đến WBS",
+    "Số lượng chuyển",
+    "Tầng nguồn",
+]
+PLAN_NO_SOURCE = "Chưa có nguồn"
+
+# Vong lap ke hoach theo tang: moi tang duoc xet cho tat ca dong thieu truoc khi sang tang xa hon.
+TRANSFER_PLAN_ROUNDS = [
+    ("Kho DA T\u1ec9nh", "wbs", lambda mat, plant, sloc, wbs: (mat, plant, wbs)),
+    ("Kho CN", "sloc", lambda mat, plant, sloc, wbs: (mat, plant, sloc)),
+    ("Kho T\u1ec9nh", "plant", lambda mat, plant, sloc, wbs: (mat, plant)),
+    ("Kho Khu v\u1ef1c", "material", lambda mat, plant, sloc, wbs: mat),
+]
+
+
+def take_plan_sources(pool: list, need: float) -> list:
+    # pool: (con lai, thu tu, nguon) tang dan. Co nguon du ca phan thieu thi lay nguon nho nhat du (1 lan chuyen),
+    # khong thi lay nguon lon nhat roi lap lai -> it lan chuyen nhat theo cach tham lam.
+    moves = []
+    while need > 1e-9 and pool:
+        pos = bisect.bisect_left(pool, (need - 1e-9,))
+        if pos < len(pool):
+            left, order, source = pool.pop(pos)
+            qty = need
+            if left - qty > 1e-9:
+                bisect.insort(pool, (left - qty, order, source))
+        else:
+            left, order, source = pool.pop()
+            qty = left
+        moves.append((source, qty))
+        need -= qty
+    return moves
+
+
+def build_transfer_plan(report_df: pd.DataFrame, stock_index: Dict[str, Any]) -> pd.DataFrame:
+    pending = report_df[report_df["Status"] != EXPORTED_STATUS]
+    short = pending[pending[COL_MISSING_STOCK] & (pending[COL_SHORTAGE] > 1e-9)]
+    if short.empty:
+        return pd.DataFrame(columns=TRANSFER_PLAN_COLUMNS)
+
+    sources = stock_index["sources"]
+    # Ton kho tu do cua moi nguon = ton duong - phan dong cung khoa dang can; nguon cua dong thieu bang 0.
+    demand = dict(zip(zip(*(pending[col] for col in ISSUE_KEY_COLUMNS)), pending["Transfer Quantity"].astype(float)))
+    supply: Dict[tuple, float] = {}
+    for mat, buckets in sources["material"].items():
+        for plant, sloc, wbs, qty in buckets:
+            free = float(qty) - demand.get((mat, plant, sloc, wbs), 0.0)
+            if free > 1e-9:
+                supply[(mat, plant, sloc, wbs)] = free
+
+    keys = list(zip(*(short[col] for col in ISSUE_KEY_COLUMNS)))
+    for key in keys:
+        supply.pop(key, None)
+    need = short[COL_SHORTAGE].astype(float).tolist()
+    # Dong thieu nhieu xet truoc (nhu first-fit decreasing), tranh bi cac dong nho chia nho nguon lon.
+    line_order = sorted(range(len(keys)), key=lambda pos: -need[pos])
+    moves: list[list] = [[] for _ in keys]
+
+    for layer, source_name, layer_key in TRANSFER_PLAN_ROUNDS:
+        pools: Dict[Any, list] = {}
+        # Luot 1 chi nhan dong ma tang nay du bu het; luot 2 moi bu mot phan cho dong con thieu.
+        for full_only in (True, False):
+            for pos in line_order:
+                if need[pos] <= 1e-9:
+                    continue
+                key = keys[pos]
+                pool_key = layer_key(*key)
+                pool = pools.get(pool_key)
+                if pool is None:
+                    entries = []
+                    for order, (plant, sloc, wbs, _) in enumerate(sources[source_name].get(pool_key, [])):
+                        source = (key[0], plant, sloc, wbs)
+                        if supply.get(source, 0.0) > 1e-9:
+                            entries.append((supply[source], order, source))
+                    entries.sort()
+                    pool = pools[pool_key] = [sum(entry[0] for entry in entries), entries]
+                if not pool[1] or (full_only and pool[0] < need[pos] - 1e-9):
+                    continue
+                for source, qty in take_plan_sources(pool[1], need[pos]):
+                    supply[source] -= qty
+                    pool[0] -= qty
+                    need[pos] -= qty
+                    moves[pos].append((source, qty, layer))
+
+    rows = []
+    lines = short[["Request Number", "Material Number", "Material Description", "Functional Location"]].itertuples(
+        index=False, name=None
+    )
+    for pos, (request, mat, description, fl) in enumerate(lines):
+        _, plant, sloc, wbs = keys[pos]
+        line = (request, mat, description, fl)
+        for (_, src_plant, src_sloc, src_wbs), qty, layer in moves[pos]:
+            rows.append(line + (src_plant, src_sloc, src_wbs, plant, sloc, wbs, qty, layer))
+        if need[pos] > 1e-9:
+            rows.append(line + ("", "", "", plant, sloc, wbs, need[pos], PLAN_NO_SOURCE))
+    return pd.DataFrame(rows, columns=TRANSFER_PLAN_COLUMNS)
+
+
+EXCEL_HEADER_FILL = "1F2937"
+EXCEL_HEADER_FONT_COLOR = "FFFFFF"
+EXCEL_BAD_FILL = "FFEDD5"
+EXCEL_BAD_ROW_SHEETS = {"ChiTietChuaDamBao"}
+EXCEL_MIN_WIDTH = 12
+EXCEL_MAX_WIDTH = 48
+# xlsxwriter cong them 5px padding (Calibri 11, 7px/ky tu) vao do rong cot; tru ra de giu dung do rong nhu openpyxl.
+EXCEL_WIDTH_PADDING = 5 / 7
+
+
+def excel_column_widths(df: pd.DataFrame) -> list[int]:
+    widths = []
+    for col in df.columns:
+        values = df[col]
+        lengths = values.astype(str).str.len().where(values.notna(), 0)
+        max_length = max(len(str(col)), int(lengths.max()) if len(lengths) else 0)
+        widths.append(min(max(max_length + 2, EXCEL_MIN_WIDTH), EXCEL_MAX_WIDTH))
+    return widths
+
+
+def excel_row_values(df: pd.DataFrame):
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        items = values.tolist()
+        missing = values.isna().to_numpy()
+        if missing.any():
+            for pos in np.flatnonzero(missing):
+                items[pos] = None
+        columns.append(items)
+    return zip(*columns)
+
+
+def write_excel_streaming(sheets: list[Tuple[str, pd.DataFrame]]) -> bytes:
+    output = io.BytesIO()
+    workbook = xlsxwriter.Workbook(
+        output,
+        {
+            "constant_memory": True,
+            "strings_to_formulas": False,
+            "strings_to_urls": False,
+            "nan_inf_to_errors": True,
+        },
+    )
+    header_format = workbook.add_format(
+        {
+            "bold": True,
+            "font_color": f"#{EXCEL_HEADER_FONT_COLOR}",
+            "bg_color": f"#{EXCEL_HEADER_FILL}",
+            "pattern": 1,
+            "align": "center",
+            "valign": "vcenter",
+        }
+    )
+    bad_format = workbook.add_format({"bg_color": f"#{EXCEL_BAD_FILL}", "pattern": 1})
+
+    for sheet_name, df in sheets:
+        ws = workbook.add_worksheet(sheet_name)
+        for col_idx, width in enumerate(excel_column_widths(df)):
+            ws.set_column(col_idx, col_idx, width - EXCEL_WIDTH_PADDING)
+        ws.freeze_panes(1, 0)
+        ws.autofilter(0, 0, len(df), max(len(df.columns) - 1, 0))
+        ws.write_row(0, 0, [str(col) for col in df.columns], header_format)
+
+        row_format = bad_format if sheet_name in EXCEL_BAD_ROW_SHEETS else None
+        for row_idx, row in enumerate(excel_row_values(df), 1):
+            ws.write_row(row_idx, 0, row, row_format)
+
+    workbook.close()
+    return output.getvalue()
+
+
+def auto_width_worksheet(ws) -> None:
+    for col_idx, column_cells in enumerate(ws.columns, 1):
+        max_length = 0
+        for cell in column_cells:
+            cell_length = len(str(cell.value)) if cell.value is not None else 0
+            max_length = max(max_length, cell_length)
+        ws.column_dimensions[get_column_letter(col_idx)].width = min(max(max_length + 2, EXCEL_MIN_WIDTH), EXCEL_MAX_WIDTH)
+
+
+def format_workbook(writer, sheet_names: list[str]) -> None:
+    wb = writer.book
+    header_fill = PatternFill("solid", fgColor=EXCEL_HEADER_FILL)
+    header_font = Font(color=EXCEL_HEADER_FONT_COLOR, bold=True)
+    bad_fill = PatternFill("solid", fgColor=EXCEL_BAD_FILL)
+
+    for sheet_name in sheet_names:
+        ws = wb[sheet_name]
+        ws.freeze_panes = "A2"
+        ws.auto_filter.ref = ws.dimensions
+        for cell in ws[1]:
+            cell.fill = header_fill
+            cell.font = header_font
+            cell.alignment = Alignment(horizontal="center", vertical="center")
+
+        if sheet_name in EXCEL_BAD_ROW_SHEETS:
+            for row in range(2, ws.max_row + 1):
+                for col in range(1, ws.max_column + 1):
+                    ws.cell(row=row, column=col).fill = bad_fill
+        auto_width_worksheet(ws)
+
+
+def write_excel_sheets(sheets: list[Tuple[str, pd.DataFrame]]) -> bytes:
+    if xlsxwriter is not None:
+        return write_excel_streaming(sheets)
+
+    # Khong co xlsxwriter thi quay ve openpyxl va dinh dang tung o nhu ban cu.
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        for sheet_name, df in sheets:
+            df.to_excel(writer, index=False, sheet_name=sheet_name)
+        format_workbook(writer, [sheet_name for sheet_name, _ in sheets])
+    return output.getvalue()
+
+
+def stock_detail_columns(report_df: pd.DataFrame) -> list[str]:
+    # Cot phan bo/serial chi co khi chay che do phan bo hoac kiem tra kem IQ09.
+    return STOCK_DETAIL_COLUMNS + [col for col in ALLOCATION_COLUMNS + SERIAL_COLUMNS if col in report_df.columns]
+
+
+def build_export_sheets(
+    full_df: pd.DataFrame,
+    mb52_meta: Dict[str, str],
+    transfer_plan: Optional[pd.DataFrame] = None,
+) -> list[Tuple[str, pd.DataFrame]]:
+    total = len(full_df)
+    ok = int(full_df["Đảm bảo 100%"].sum())
+    not_ok = total - ok
+    sheets = [("KetLuan", build_conclusion_sheet(total, ok, not_ok, mb52_meta))]
+
+    if not_ok > 0:
+        error_df = full_df.loc[~full_df["Đảm bảo 100%"], DETAIL_COLUMNS]
+        stock_detail_df = full_df.loc[~full_df["Đảm bảo 100%"], stock_detail_columns(full_df)]
+        summary_fl, summary_material, summary_plant, stock_suggestion = build_stock_summaries(full_df)
+        sheets.extend([
+            ("ChiTietChuaDamBao", error_df),
+            ("GoiYXuLy", error_df[
+                [
+                    "Request Number",
+                    "Material Number",
+                    "Material Description",
+                    "Plant",
+                    "Functional Location",
+                    "Còn thiếu",
+                    "Tình trạng",
+                    "Gợi ý xử lý",
+                ]
+            ]),
+            ("PhanTangKho", stock_detail_df),
+            ("TongHopThieuKho_FL", summary_fl),
+            ("TongHopThieuKho_VatTu", summary_material),
+            ("TongHopThieuKho_Plant", summary_plant),
+            ("GoiYChuyenKho", stock_suggestion),
+        ])
+        if transfer_plan is not None and not transfer_plan.empty:
+            sheets.append(("KeHoachChuyenKho", transfer_plan))
+
+    return sheets
+
+
+def export_excel(
+    full_df: pd.DataFrame,
+    issue_df: pd.DataFrame,
+    mb52_meta: Dict[str, str],
+    transfer_plan: Optional[pd.DataFrame] = None,
+) -> bytes:
+    return write_excel_sheets(build_export_sheets(full_df, mb52_meta, transfer_plan))
+
+
+def export_csv_zip(
+    full_df: pd.DataFrame,
+    mb52_meta: Dict[str, str],
+    transfer_plan: Optional[pd.DataFrame] = None,
+) -> bytes:
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as archive:
+        for sheet_name, df in build_export_sheets(full_df, mb52_meta, transfer_plan):
+            # utf-8-sig de Excel mo CSV tieng Viet khong loi font.
+            archive.writestr(f"{sheet_name}.csv", df.to_csv(index=False).encode("utf-8-sig"))
+    return output.getvalue()
+
+
+def export_parquet(full_df: pd.DataFrame) -> bytes:
+    # Cot object tu file phieu co the tron so va chuoi; Parquet can mot kieu moi cot.
+    object_cols = full_df.select_dtypes(include="object").columns
+    parquet_df = full_df.astype({col: "str" for col in object_cols}) if len(object_cols) else full_df
+    output = io.BytesIO()
+    parquet_df.to_parquet(output, index=False)
+    return output.getvalue()
+
+
+EXPORT_FORMATS = {
+    "xlsx": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "csv": (".zip", "application/zip"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+
+def export_report(
+    full_df: pd.DataFrame,
+    issue_df: pd.DataFrame,
+    mb52_meta: Dict[str, str],
+    fmt: str = "xlsx",
+    transfer_plan: Optional[pd.DataFrame] = None,
+) -> bytes:
+    if fmt == "csv":
+        return export_csv_zip(full_df, mb52_meta, transfer_plan)
+    if fmt == "parquet":
+        return export_parquet(full_df)
+    return export_excel(full_df, issue_df, mb52_meta, transfer_plan)
+
+
+# =====================================================
+# HEADLESS CHECK
+# =====================================================
+def read_mb52_source(source: str) -> Tuple[bytes, Dict[str, str]]:
+    if re.match(r"https?://", source, re.I):
+        return download_mb52_from_github(source)
+    return read_local_mb52(source)
+
+
+def check_issue(
+    issue_df: pd.DataFrame,
+    mb52_raw: Optional[pd.DataFrame],
+    stock_index: Optional[Dict[str, Any]] = None,
+    timer: Optional[StageTimer] = None,
+    serial_index: Optional[Dict[str, Any]] = None,
+    allocation: Optional[str] = None,
+) -> pd.DataFrame:
+    stock_report = build_sequential_5_layer(issue_df, mb52_raw, stock_index, timer, serial_index, allocation)
+    return build_business_conclusion(stock_report)
+
+
+def update_check_result(
+    previous_report: pd.DataFrame,
+    issue_df: pd.DataFrame,
+    stock_index: Dict[str, Any],
+    changed: pd.Index,
+    serial_index: Optional[Dict[str, Any]] = None,
+) -> pd.DataFrame:
+    # Dong Status 12 khong phu thuoc MB52; dong 1/5/9 chi doi khi Material cua dong co trong danh sach thay doi.
+    # Khong dung cho che do phan bo vi thu tu phan bo tinh tren toan phieu.
+    pending = issue_df[issue_df["Status"].isin(STOCK_CHECK_STATUSES) & issue_df["Material Number"].isin(changed)]
+    if pending.empty:
+        return previous_report
+    affected = build_pending_stock_report(pending, None, stock_index, serial_index)
+    positions = previous_report.index[
+        (previous_report["Status"] != EXPORTED_STATUS) & previous_report["Material Number"].isin(changed)
+    ]
+    # Nhom dong theo khoa da sap xep nen cac dong tinh lai khop dung thu tu cac dong cu cung Material.
+    report = pd.concat([previous_report.drop(index=positions), affected.set_axis(positions)], sort=False)
+    return report.sort_index().reset_index(drop=True)
+
+
+def stock_layer_items(
+    stock_index: Dict[str, Any],
+    stock_col: str,
+    materials: Optional[pd.Index] = None,
+) -> Tuple[list, pd.DataFrame]:
+    vocab = stock_index["vocab"]
+    frame = stock_index[stock_col]
+    if materials is not None:
+        frame = frame.loc[frame["Material"].isin(vocab["Material"].get_indexer(materials))]
+    key_tuples = list(zip(*(vocab[col].take(frame[col].to_numpy()).tolist() for col in STOCK_LAYER_KEYS[stock_col])))
+    return key_tuples, frame
+
+
+def build_stock_lookup(stock_index: Dict[str, Any]) -> Dict[str, Dict[tuple, Any]]:
+    # Tra cuu diem theo khoa chuoi cho truy van tung dong: dict thay cho merge DataFrame.
+    lookup: Dict[str, Dict[tuple, Any]] = {}
+    for stock_col in STOCK_LAYER_KEYS:
+        key_tuples, frame = stock_layer_items(stock_index, stock_col)
+        lookup[stock_col] = dict(zip(key_tuples, frame[stock_col].to_numpy(dtype=float).tolist()))
+        if COL_MATCHED_ROWS in frame.columns:
+            lookup[COL_MATCHED_ROWS] = dict(zip(key_tuples, frame[COL_MATCHED_ROWS].tolist()))
+    return lookup
+
+
+def update_stock_lookup(
+    stock_lookup: Dict[str, Dict[tuple, Any]],
+    previous_index: Dict[str, Any],
+    stock_index: Dict[str, Any],
+    changed: pd.Index,
+) -> Dict[str, Dict[tuple, Any]]:
+    # Bo khoa cu cua Material thay doi (lay tu chi muc cu) roi nap khoa moi; ban cu van phuc vu request dang chay.
+    lookup = {name: dict(entries) for name, entries in stock_lookup.items()}
+    for stock_col in STOCK_LAYER_KEYS:
+        old_keys, _ = stock_layer_items(previous_index, stock_col, changed)
+        key_tuples, frame = stock_layer_items(stock_index, stock_col, changed)
+        names = [stock_col] + ([COL_MATCHED_ROWS] if COL_MATCHED_ROWS in frame.columns else [])
+        for name in names:
+            for key in old_keys:
+                lookup[name].pop(key, None)
+        lookup[stock_col].update(zip(key_tuples, frame[stock_col].to_numpy(dtype=float).tolist()))
+        if COL_MATCHED_ROWS in frame.columns:
+            lookup[COL_MATCHED_ROWS].update(zip(key_tuples, frame[COL_MATCHED_ROWS].tolist()))
+    return lookup
+
+
+def record_quantity(value: Any) -> float:
+    try:
+        qty = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if np.isnan(qty) else qty
+
+
+def join_unique_values(values: list, limit: int = 8) -> str:
+    distinct = list(dict.fromkeys(text for text in values if text != ""))
+    text = ", ".join(distinct[:limit])
+    if len(distinct) > limit:
+        text += f", +{len(distinct) - limit}"
+    return text
+
+
+def pending_record(
+    key: tuple,
+    group: Dict[str, Any],
+    stock_index: Dict[str, Any],
+    stock_lookup: Dict[str, Dict[tuple, Any]],
+) -> Dict[str, Any]:
+    mat, plant, sloc, wbs = key
+    qty = group["Transfer Quantity"]
+    stocks = {
+        stock_col: stock_lookup[stock_col].get(tuple(key[pos] for pos in positions), 0.0)
+        for stock_col, positions in STOCK_LAYER_KEY_POSITIONS.items()
+    }
+    direct_stock = stocks["T\u1ed3n kho DA CN"]
+    is_ok = qty <= direct_stock
+    layer = next(
+        (label for stock_col, label in STOCK_LAYER_LABELS.items() if qty <= stocks[stock_col]),
+        LAYER_NOT_ENOUGH,
+    )
+    suggestion = transfer_suggestion(stock_index["sources"], layer, mat, plant, sloc, wbs)
+    return {
+        "Request Number": join_unique_values(group["Request Number"]),
+        "Material Number": mat,
+        "Material Description": group["Material Description"],
+        "Plant": plant,
+        "Source WBS": wbs,
+        "Sending Sloc": sloc,
+        "Functional Location": join_unique_values(group["Functional Location"]),
+        "Transfer Quantity": qty,
+        "Actual Quantity": group["Actual Quantity"],
+        "Status": join_unique_values(group["Status"]),
+        COL_CHECK_KEY: f"Material={mat} | Plant={plant} | Sloc={sloc} | WBS={wbs}",
+        COL_MATCHED_ROWS: stock_lookup[COL_MATCHED_ROWS].get(key, 0),
+        COL_DIRECT_STOCK: direct_stock,
+        COL_PROCESS_QTY: qty,
+        COL_SHORTAGE: max(qty - direct_stock, 0.0),
+        COL_BUSINESS_STATUS: PENDING_STATUS_OK if is_ok else PENDING_STATUS_SHORT,
+        COL_ACTION: ACTION_STOCK_OK if is_ok else suggestion,
+        COL_LAYER: layer,
+        COL_SUGGEST_TRANSFER: suggestion,
+        "Report Status": REPORT_STATUS_OK if is_ok else REPORT_STATUS_NOT_OK,
+        COL_MISSING_STOCK: not is_ok,
+        COL_OK: is_ok,
+        **stocks,
+    }
+
+
+def exported_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    transfer_qty = record_quantity(record.get("Transfer Quantity"))
+    actual_qty = record_quantity(record.get("Actual Quantity"))
+    difference = transfer_qty - actual_qty
+    is_equal = abs(difference) < 1e-9
+    is_short = not is_equal and actual_qty < transfer_qty
+    shortage = 0.0 if difference < 0 else difference
+    if is_equal:
+        status_text, action = EXPORTED_STATUS_EQUAL, EXPORTED_ACTION_EQUAL
+    elif is_short:
+        status_text, action = EXPORTED_STATUS_SHORT, EXPORTED_ACTION_SHORT
+    else:
+        status_text, action = EXPORTED_STATUS_OVER, EXPORTED_ACTION_OVER
+    return {
+        "Request Number": record.get("Request Number"),
+        "Material Number": normalize_key_value(record.get("Material Number"), strip_leading_zeros=True),
+        "Material Description": record.get("Material Description"),
+        "Plant": normalize_key_value(record.get("Plant")),
+        "Source WBS": normalize_key_value(record.get("Source WBS")),
+        "Sending Sloc": normalize_key_value(record.get("Sending Sloc"), strip_leading_zeros=True),
+        "Functional Location": normalize_key_value(record.get("Functional Location")),
+        "Transfer Quantity": transfer_qty,
+        "Actual Quantity": actual_qty,
+        "Status": EXPORTED_STATUS,
+        COL_CHECK_KEY: EXPORTED_CHECK_KEY,
+        COL_MATCHED_ROWS: 0,
+        COL_DIRECT_STOCK: 0.0,
+        COL_PROCESS_QTY: shortage,
+        COL_SHORTAGE: shortage,
+        COL_BUSINESS_STATUS: status_text,
+        COL_ACTION: action,
+        COL_LAYER: EXPORTED_LAYER,
+        COL_SUGGEST_TRANSFER: EXPORTED_SUGGEST_TRANSFER,
+        "Report Status": REPORT_STATUS_OK if is_equal else REPORT_STATUS_NOT_OK,
+        COL_MISSING_STOCK: False,
+        COL_OK: is_equal,
+        **{stock_col: 0.0 for stock_col in STOCK_COLUMNS},
+    }
+
+
+def check_issue_records(
+    records: list[Dict[str, Any]],
+    stock_index: Dict[str, Any],
+    stock_lookup: Optional[Dict[str, Dict[tuple, Any]]] = None,
+) -> list[Dict[str, Any]]:
+    # Cung ket qua voi check_issue nhung chay tren list dict: vai dong thi nhanh hon nhieu so voi dung DataFrame.
+    if stock_lookup is None:
+        stock_lookup = build_stock_lookup(stock_index)
+
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    exported = []
+    for record in records:
+        status = normalize_key_value(record.get("Status"), strip_leading_zeros=True)
+        if status == EXPORTED_STATUS:
+            exported.append(exported_record(record))
+            continue
+        if status not in STOCK_CHECK_STATUSES:
+            continue
+
+        key = tuple(normalize_key_value(record.get(col), strip) for col, strip in ISSUE_KEY_STRIP_ZEROS.items())
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                "Material Description": None,
+                "Transfer Quantity": 0.0,
+                "Actual Quantity": 0.0,
+                "Request Number": [],
+                "Functional Location": [],
+                "Status": [],
+            }
+        description = record.get("Material Description")
+        if group["Material Description"] is None and not pd.isna(description):
+            group["Material Description"] = description
+        group["Transfer Quantity"] += record_quantity(record.get("Transfer Quantity"))
+        group["Actual Quantity"] += record_quantity(record.get("Actual Quantity"))
+        request = record.get("Request Number")
+        if not pd.isna(request):
+            group["Request Number"].append(str(request).strip())
+        group["Functional Location"].append(normalize_key_value(record.get("Functional Location")))
+        group["Status"].append(status)
+
+    pending = [pending_record(key, groups[key], stock_index, stock_lookup) for key in sorted(groups)]
+    return pending + exported
+
+
+def summarize_report(final_report: pd.DataFrame) -> Dict[str, int]:
+    total = len(final_report)
+    ok = int(final_report[COL_OK].sum())
+    return {"total": total, "ok": ok, "not_ok": total - ok}
+
+
+REPORT_SEARCH_COLUMNS = [
+    "Request Number",
+    "Material Number",
+    "Material Description",
+    "Functional Location",
+    "Source WBS",
+    "Sending Sloc",
+]
+REPORT_FILTER_COLUMNS = [COL_BUSINESS_STATUS, "Plant", "Functional Location", COL_LAYER, "Sending Sloc"]
+
+
+def build_filter_index(report_df: pd.DataFrame) -> Dict[str, Any]:
+    # Ma hoa moi cot mot lan: codes theo dong + gia tri duy nhat, loc chi con tra cuu tren gia tri duy nhat.
+    encoded = {}
+    for column in dict.fromkeys(REPORT_SEARCH_COLUMNS + REPORT_FILTER_COLUMNS):
+        if column in report_df.columns:
+            codes, uniques = pd.factorize(report_df[column].astype(str))
+            encoded[column] = (codes, uniques.tolist())
+
+    search = [
+        (encoded[column][0], [value.lower() for value in encoded[column][1]])
+        for column in REPORT_SEARCH_COLUMNS
+        if column in encoded
+    ]
+    columns = {}
+    for column in REPORT_FILTER_COLUMNS:
+        if column in encoded:
+            codes, uniques = encoded[column]
+            columns[column] = {
+                "codes": codes,
+                "lookup": {value: code for code, value in enumerate(uniques)},
+                "options": sorted(value for value in uniques if value.strip() != ""),
+            }
+    return {"rows": len(report_df), "search": search, "columns": columns}
+
+
+def filter_options(filter_index: Dict[str, Any], column: str) -> list[str]:
+    entry = filter_index["columns"].get(column)
+    return entry["options"] if entry else []
+
+
+def filter_index_mask(
+    filter_index: Dict[str, Any],
+    keyword: str = "",
+    selections: Optional[Dict[str, list[str]]] = None,
+) -> np.ndarray:
+    # Co them mot o False cuoi mang de code -1 (o trong) tu dong khong khop.
+    mask = np.ones(filter_index["rows"], dtype=bool)
+    keyword = keyword.strip().lower()
+    if keyword:
+        hit = np.zeros(filter_index["rows"], dtype=bool)
+        for codes, lowered in filter_index["search"]:
+            matched = np.fromiter((keyword in value for value in lowered), dtype=bool, count=len(lowered))
+            hit |= np.append(matched, False)[codes]
+        mask &= hit
+
+    for column, values in (selections or {}).items():
+        entry = filter_index["columns"].get(column)
+        if not values or entry is None:
+            continue
+        selected = np.zeros(len(entry["lookup"]) + 1, dtype=bool)
+        selected[[entry["lookup"][value] for value in values if value in entry["lookup"]]] = True
+        mask &= selected[entry["codes"]]
+    return mask
+
+
+class CheckResultCache:
+    def __init__(self, max_entries: int = CHECK_RESULT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[pd.DataFrame, float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def get_or_compute(
+        self,
+        issue_digest: str,
+        mb52_digest: str,
+        compute: Callable[[], pd.DataFrame],
+        base: Optional[Tuple[str, Callable[[pd.DataFrame], pd.DataFrame]]] = None,
+    ) -> Tuple[pd.DataFrame, bool, float]:
+        # Ket qua tra ve dung chung giua cac phien, noi goi khong duoc sua truc tiep.
+        # base = (digest MB52 truoc, ham cap nhat): co ket qua cu cua cung phieu thi chi cap nhat phan thay doi.
+        key = (issue_digest, mb52_digest)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                report, seconds = self.entries[key]
+                return report, True, seconds
+            previous = self.entries.get((issue_digest, base[0])) if base is not None else None
+
+        started = time.perf_counter()
+        report = base[1](previous[0]) if previous is not None else compute()
+        seconds = time.perf_counter() - started
+
+        with self.lock:
+            self.misses += 1
+            self.updates += previous is not None
+            self.entries[key] = (report, seconds)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return report, False, seconds
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "updates": self.updates,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+            }
@@ -0,0 +1,387 @@
+# =====================================================
+# STOCKFLOW HISTORY - LUU LICH SU MB52 VA KIEM TRA THEO THOI DIEM
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import argparse
+import contextlib
+import datetime
+import os
+import re
+import sqlite3
+import sys
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import pandas as pd
+
+from stockflow_engine import (
+    APP_VERSION,
+    COL_LAYER,
+    COL_OK,
+    MB52_HISTORY_DIR,
+    StockCheckError,
+    build_stock_index,
+    check_issue,
+    export_excel,
+    load_issue,
+    load_mb52,
+    read_mb52_source,
+    refresh_stock_index,
+    summarize_report,
+    update_check_result,
+    write_excel_sheets,
+    write_file_atomic,
+)
+
+
+HISTORY_CATALOG_NAME = "catalog.sqlite"
+HISTORY_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+HISTORY_INPUT_TIME_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d",
+    "%d/%m/%Y %H:%M:%S",
+    "%d/%m/%Y %H:%M",
+    "%d/%m/%Y",
+)
+HISTORY_LINE_KEY_COLUMNS = ["Request Number", "Material Number", "Plant", "Sending Sloc", "Source WBS", "Transfer Quantity"]
+
+# snapshots: moi noi dung MB52 (theo SHA256 file) luu mot lan thanh Parquet nen theo cot.
+# observations: moi lan MB52 cua mot nguon (url: GitHub URL hoac duong dan tuyet doi) doi noi dung;
+# snapshot co hieu luc tu observed_at den lan quan sat ke tiep cua cung nguon do.
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    sha256 TEXT PRIMARY KEY,
+    rows INTEGER NOT NULL,
+    materials INTEGER NOT NULL,
+    data_file TEXT NOT NULL,
+    data_bytes INTEGER NOT NULL,
+    stored_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS observations (
+    observed_at TEXT NOT NULL,
+    sha256 TEXT NOT NULL REFERENCES snapshots (sha256),
+    source TEXT NOT NULL DEFAULT '',
+    url TEXT NOT NULL DEFAULT '',
+    last_modified TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS observations_time ON observations (observed_at);
+CREATE INDEX IF NOT EXISTS observations_feed_time ON observations (url, observed_at);
+"""
+HISTORY_SELECT = """
+SELECT o.observed_at, o.sha256, o.source, o.url, o.last_modified, s.rows, s.materials
+FROM observations AS o JOIN snapshots AS s USING (sha256)
+"""
+
+
+def parse_history_time(value: str) -> datetime.datetime:
+    for time_format in HISTORY_INPUT_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), time_format)
+        except ValueError:
+            continue
+    raise ValueError(f"Không đọc được thời điểm '{value}', dùng dạng YYYY-MM-DD HH:MM hoặc DD/MM/YYYY HH:MM.")
+
+
+def format_history_time(value: datetime.datetime) -> str:
+    return value.strftime(HISTORY_TIME_FORMAT)
+
+
+def history_feed(url: str) -> str:
+    # Cung mot file local co the duoc goi bang duong dan tuong doi/tuyet doi khac nhau: quy ve mot khoa nguon.
+    if not url or re.match(r"https?://", url, re.I):
+        return url
+    return os.path.normcase(os.path.abspath(url))
+
+
+class SnapshotStore:
+    def __init__(self, folder: str = MB52_HISTORY_DIR):
+        self.folder = folder
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        with self.catalog() as conn:
+            conn.executescript(HISTORY_SCHEMA)
+
+    @contextlib.contextmanager
+    def catalog(self) -> Iterator[sqlite3.Connection]:
+        # Moi thao tac mo ket noi rieng: dung duoc tu nhieu luong (phien Streamlit, server) ma khong chia se ket noi.
+        conn = sqlite3.connect(os.path.join(self.folder, HISTORY_CATALOG_NAME), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def data_path(self, data_file: str) -> str:
+        return os.path.join(self.folder, data_file)
+
+    def record(
+        self,
+        mb52_raw: pd.DataFrame,
+        meta: Dict[str, str],
+        observed_at: Optional[datetime.datetime] = None,
+    ) -> bool:
+        sha256 = meta["sha256"]
+        feed = history_feed(meta.get("url", ""))
+        observed = format_history_time(observed_at or datetime.datetime.now())
+        with self.lock, self.catalog() as conn:
+            if conn.execute("SELECT 1 FROM snapshots WHERE sha256 = ?", (sha256,)).fetchone() is None:
+                data_file = f"{sha256}.parquet"
+                write_file_atomic(
+                    self.data_path(data_file),
+                    lambda path: mb52_raw.to_parquet(path, index=False, compression="zstd"),
+                )
+                conn.execute(
+                    "INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        sha256,
+                        len(mb52_raw),
+                        int(mb52_raw["Material"].nunique()),
+                        data_file,
+                        os.path.getsize(self.data_path(data_file)),
+                        format_history_time(datetime.datetime.now()),
+                    ),
+                )
+
+            # Chi ghi lan quan sat khi noi dung khac snapshot dang co hieu luc cua chinh nguon nay tai thoi diem do;
+            # nguon khac (vd GitHub va file local) co dong thoi gian rieng, khong xen ke nhau.
+            current = conn.execute(
+                "SELECT sha256 FROM observations WHERE url = ? AND observed_at <= ? "
+                "ORDER BY observed_at DESC, rowid DESC LIMIT 1",
+                (feed, observed),
+            ).fetchone()
+            if current is not None and current[0] == sha256:
+                return False
+            conn.execute(
+                "INSERT INTO observations VALUES (?, ?, ?, ?, ?)",
+                (observed, sha256, meta.get("source", ""), feed, meta.get("last_modified", "")),
+            )
+            return True
+
+    def feeds(self) -> list[str]:
+        with self.catalog() as conn:
+            return [row[0] for row in conn.execute("SELECT DISTINCT url FROM observations ORDER BY url")]
+
+    def resolve_feed(self, feed: Optional[str]) -> Optional[str]:
+        # Kiem tra theo thoi diem chi co nghia tren dong thoi gian cua mot nguon MB52.
+        if feed is not None:
+            return history_feed(feed)
+        feeds = self.feeds()
+        if len(feeds) > 1:
+            raise StockCheckError("Lịch sử có nhiều nguồn MB52, cần chọn một nguồn (--feed): " + ", ".join(feeds))
+        return feeds[0] if feeds else None
+
+    def history(
+        self,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        feed: Optional[str] = None,
+    ) -> pd.DataFrame:
+        # Gom snapshot dang co hieu luc tai start va moi lan doi noi dung trong (start, end]; feed=None: moi nguon.
+        params: list[str] = []
+        clauses = []
+        if feed is not None:
+            clauses.append("o.url = ?")
+            params.append(history_feed(feed))
+        if start is not None:
+            clauses.append(
+                "(o.observed_at > ? OR o.rowid = (SELECT rowid FROM observations AS p WHERE p.observed_at <= ? "
+                "AND p.url = o.url ORDER BY p.observed_at DESC, p.rowid DESC LIMIT 1))"
+            )
+            params += [format_history_time(start)] * 2
+        if end is not None:
+            clauses.append("o.observed_at <= ?")
+            params.append(format_history_time(end))
+        query = HISTORY_SELECT + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY o.observed_at, o.rowid"
+        with self.catalog() as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    def snapshot_at(self, when: datetime.datetime, feed: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        feed = self.resolve_feed(feed)
+        with self.catalog() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                HISTORY_SELECT + " WHERE o.url = ? AND o.observed_at <= ? ORDER BY o.observed_at DESC, o.rowid DESC LIMIT 1",
+                (feed or "", format_history_time(when)),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def load(self, sha256: str) -> pd.DataFrame:
+        with self.catalog() as conn:
+            row = conn.execute("SELECT data_file FROM snapshots WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None:
+            raise StockCheckError(f"Không có snapshot MB52 {sha256} trong lịch sử.")
+        return pd.read_parquet(self.data_path(row[0]))
+
+    def check_at(
+        self,
+        issue_df: pd.DataFrame,
+        when: datetime.datetime,
+        serial_index: Optional[Dict[str, Any]] = None,
+        allocation: Optional[str] = None,
+        feed: Optional[str] = None,
+    ) -> Tuple[Dict[str, Any], pd.DataFrame]:
+        snapshot = self.snapshot_at(when, feed)
+        if snapshot is None:
+            raise StockCheckError(f"Chưa có snapshot MB52 nào tại hoặc trước {format_history_time(when)}.")
+        mb52_raw = self.load(snapshot["sha256"])
+        report = check_issue(issue_df, mb52_raw, build_stock_index(mb52_raw), serial_index=serial_index, allocation=allocation)
+        return snapshot, report
+
+    def check_range(
+        self,
+        issue_df: pd.DataFrame,
+        start: Optional[datetime.datetime] = None,
+        end: Optional[datetime.datetime] = None,
+        serial_index: Optional[Dict[str, Any]] = None,
+        allocation: Optional[str] = None,
+        feed: Optional[str] = None,
+    ) -> list[Tuple[Dict[str, Any], pd.DataFrame]]:
+        # Doc snapshot tu Parquet theo thu tu thoi gian; tu snapshot thu hai chi cap nhat cac Material thay doi.
+        feed = self.resolve_feed(feed)
+        if feed is None:
+            return []
+        results = []
+        stock_index: Optional[Dict[str, Any]] = None
+        report: Optional[pd.DataFrame] = None
+        for snapshot in self.history(start, end, feed).to_dict("records"):
+            mb52_raw = self.load(snapshot["sha256"])
+            if stock_index is None or allocation is not None:
+                stock_index = build_stock_index(mb52_raw)
+                report = check_issue(issue_df, mb52_raw, stock_index, serial_index=serial_index, allocation=allocation)
+            else:
+                stock_index, changed = refresh_stock_index(stock_index, mb52_raw)
+                report = update_check_result(report, issue_df, stock_index, changed, serial_index)
+            results.append((snapshot, report))
+        return results
+
+
+def build_history_timeline(results: list[Tuple[Dict[str, Any], pd.DataFrame]]) -> pd.DataFrame:
+    rows = []
+    for snapshot, report in results:
+        summary = summarize_report(report)
+        rows.append(
+            {
+                "Thời điểm": snapshot["observed_at"],
+                "MB52 SHA256": snapshot["sha256"],
+                "Nguồn MB52": snapshot["source"],
+                "Dòng MB52": snapshot["rows"],
+                "Tổng dòng": summary["total"],
+                "Đã xuất đủ": summary["ok"],
+                "Chưa đảm bảo": summary["not_ok"],
+                "Tỷ lệ đảm bảo": f"{(summary['ok'] / summary['total'] * 100) if summary['total'] else 0:.1f}%",
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def build_history_line_matrix(results: list[Tuple[Dict[str, Any], pd.DataFrame]]) -> pd.DataFrame:
+    # Cung mot phieu nen cac bao cao cung so dong va cung thu tu; moi snapshot them mot cot tang dap ung.
+    if not results:
+        return pd.DataFrame(columns=HISTORY_LINE_KEY_COLUMNS)
+    matrix = results[0][1][HISTORY_LINE_KEY_COLUMNS].copy()
+    for snapshot, report in results:
+        matrix[snapshot["observed_at"]] = report[COL_LAYER].where(~report[COL_OK], report[COL_LAYER] + " ✓").to_numpy()
+    return matrix
+
+
+def export_history_excel(results: list[Tuple[Dict[str, Any], pd.DataFrame]]) -> bytes:
+    return write_excel_sheets(
+        [
+            ("LichSu", build_history_timeline(results)),
+            ("TheoThoiGian", build_history_line_matrix(results)),
+        ]
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stockflow-history",
+        description="Lưu lịch sử MB52 và kiểm tra phiếu xuất kho theo snapshot tại một thời điểm hoặc trong một khoảng thời gian.",
+    )
+    parser.add_argument(
+        "--history-dir",
+        default=MB52_HISTORY_DIR,
+        help=f"Thư mục lưu lịch sử MB52 (mặc định: {MB52_HISTORY_DIR})",
+    )
+    parser.add_argument("--version", action="version", version=f"%(prog)s {APP_VERSION}")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    add = commands.add_parser("add", help="Lưu một file MB52 vào lịch sử")
+    add.add_argument("mb52", help="File MB52 hoặc GitHub Raw URL")
+    add.add_argument("--at", type=parse_history_time, help="Thời điểm MB52 có hiệu lực (mặc định: bây giờ)")
+
+    history = commands.add_parser("list", help="Liệt kê các snapshot MB52 đã lưu")
+    history.add_argument("--from", dest="start", type=parse_history_time, help="Từ thời điểm")
+    history.add_argument("--to", dest="end", type=parse_history_time, help="Đến thời điểm")
+    history.add_argument("--feed", help="Chỉ liệt kê một nguồn MB52 (GitHub Raw URL hoặc đường dẫn file)")
+
+    check = commands.add_parser("check", help="Kiểm tra phiếu xuất kho theo MB52 trong lịch sử")
+    check.add_argument("issue", help="File phiếu xuất kho (.xlsx)")
+    check.add_argument("--at", type=parse_history_time, help="Dùng MB52 có hiệu lực tại thời điểm này")
+    check.add_argument("--from", dest="start", type=parse_history_time, help="Kiểm tra mọi snapshot từ thời điểm này")
+    check.add_argument("--to", dest="end", type=parse_history_time, help="Kiểm tra mọi snapshot đến thời điểm này")
+    check.add_argument("--feed", help="Nguồn MB52 (GitHub Raw URL hoặc đường dẫn file), bắt buộc khi lịch sử có nhiều nguồn")
+    check.add_argument("--output", help="File kết quả .xlsx (mặc định: cạnh file phiếu)")
+    return parser
+
+
+def history_output_path(issue_path: str, label: str) -> str:
+    stem = os.path.splitext(os.path.abspath(issue_path))[0]
+    return f"{stem}_{label}.xlsx"
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    try:
+        store = SnapshotStore(args.history_dir)
+        if args.command == "add":
+            file_bytes, meta = read_mb52_source(args.mb52)
+            mb52_raw = load_mb52(file_bytes, meta)
+            added = store.record(mb52_raw, meta, args.at)
+            print(f"MB52 {meta['sha256'][:12]}: {len(mb52_raw):,} dòng · {'đã lưu' if added else 'trùng snapshot đang có hiệu lực'}")
+            return 0
+
+        if args.command == "list":
+            history = store.history(args.start, args.end, args.feed)
+            if history.empty:
+                print("Chưa có snapshot MB52 nào trong khoảng thời gian này.")
+            for row in history.itertuples(index=False):
+                print(f"{row.observed_at} · {row.sha256[:12]} · {row.rows:,} dòng · {row.materials:,} mã vật tư · {row.url}")
+            return 0
+
+        with open(args.issue, "rb") as file:
+            issue_df = load_issue(file.read())
+        if args.at is not None:
+            snapshot, report = store.check_at(issue_df, args.at, feed=args.feed)
+            output_path = args.output or history_output_path(args.issue, f"KetQua_{args.at:%Y%m%d_%H%M}")
+            data = export_excel(report, issue_df, {"source": f"Lịch sử MB52 {snapshot['observed_at']}", "url": snapshot["sha256"]})
+            summary = summarize_report(report)
+            print(
+                f"MB52 lúc {snapshot['observed_at']} ({snapshot['sha256'][:12]}): {summary['total']:,} dòng · "
+                f"đã xuất đủ {summary['ok']:,} · chưa đảm bảo {summary['not_ok']:,} -> {output_path}"
+            )
+        else:
+            results = store.check_range(issue_df, args.start, args.end, feed=args.feed)
+            if not results:
+                print("Chưa có snapshot MB52 nào trong khoảng thời gian này.", file=sys.stderr)
+                return 2
+            output_path = args.output or history_output_path(args.issue, "LichSu")
+            data = export_history_excel(results)
+            for row in build_history_timeline(results).itertuples(index=False):
+                print(f"{row[0]} · {row[1][:12]} · đã xuất đủ {row[5]:,}/{row[4]:,} ({row[7]})")
+            print(f"{len(results)} snapshot -> {output_path}")
+    except (OSError, ImportError, StockCheckError, ValueError, sqlite3.Error) as exc:
+        print(f"Lỗi: {exc}", file=sys.stderr)
+        return 2
+
+    with open(output_path, "wb") as file:
+        file.write(data)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,275 @@
+# =====================================================
+# STOCKFLOW SERVER - DICH VU HTTP KIEM TRA PHIEU VOI CHI MUC MB52 NAP SAN
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import argparse
+import datetime
+import http.server
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import zipfile
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+from stockflow_engine import (
+    APP_VERSION,
+    COL_OK,
+    LOCAL_MB52_PATH,
+    MB52_HISTORY_DIR,
+    StockCheckError,
+    build_stock_index,
+    build_stock_lookup,
+    check_issue,
+    check_issue_records,
+    load_issue,
+    load_mb52,
+    read_mb52_source,
+    refresh_stock_index,
+    update_stock_lookup,
+)
+from stockflow_history import SnapshotStore
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_RELOAD_INTERVAL = 60
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+class StockService:
+    def __init__(self, source: str, history: Optional[SnapshotStore] = None):
+        self.source = source
+        self.history = history
+        self.snapshot: Optional[Dict[str, Any]] = None
+        self.reload_lock = threading.Lock()
+
+    def source_stat(self) -> Optional[Tuple[float, int]]:
+        if re.match(r"https?://", self.source, re.I):
+            return None
+        stat = os.stat(self.source)
+        return stat.st_mtime, stat.st_size
+
+    def reload(self, force: bool = False) -> bool:
+        # Chi mot luong duoc nap lai; snapshot moi dung xong het moi gan vao self.snapshot.
+        with self.reload_lock:
+            current = self.snapshot
+            stat = self.source_stat()
+            if current is not None and not force and stat is not None and stat == current["stat"]:
+                return False
+
+            file_bytes, meta = read_mb52_source(self.source)
+            if current is not None and not force and meta["sha256"] == current["meta"]["sha256"]:
+                # Khong sua snapshot da cong bo: thay bang ban sao chi khac stat.
+                self.snapshot = {**current, "stat": stat}
+                return False
+
+            mb52_raw = load_mb52(file_bytes, meta)
+            self.record_history(mb52_raw, meta)
+            if current is None:
+                stock_index = build_stock_index(mb52_raw)
+                stock_lookup = build_stock_lookup(stock_index)
+                changed = None
+            else:
+                # MB52 moi thuong chi doi mot phan nho Material: cap nhat chi muc tu snapshot cu.
+                stock_index, changed = refresh_stock_index(current["stock_index"], mb52_raw)
+                stock_lookup = update_stock_lookup(current["stock_lookup"], current["stock_index"], stock_index, changed)
+            # Gan mot tham chieu duy nhat: request dang chay giu snapshot cu, request moi thay snapshot moi.
+            self.snapshot = {
+                "meta": meta,
+                "stat": stat,
+                "rows": len(mb52_raw),
+                "materials": int(mb52_raw["Material"].nunique()),
+                "changed_materials": None if changed is None else len(changed),
+                "stock_index": stock_index,
+                "stock_lookup": stock_lookup,
+                "loaded_at": datetime.datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            }
+            return True
+
+    def record_history(self, mb52_raw: pd.DataFrame, meta: Dict[str, str]) -> None:
+        # Lich su chi de tra cuu ve sau; loi ghi lich su khong duoc chan viec nap snapshot moi.
+        if self.history is None:
+            return
+        try:
+            self.history.record(mb52_raw, meta)
+        except (OSError, ImportError, ValueError, sqlite3.Error) as exc:
+            print(f"Không lưu được lịch sử MB52: {exc}", file=sys.stderr, flush=True)
+
+    def watch(self, interval: float, stop: threading.Event) -> None:
+        while not stop.wait(interval):
+            try:
+                if self.reload():
+                    print(f"Đã nạp lại MB52: {self.snapshot_info()}", flush=True)
+            except (OSError, StockCheckError, ValueError) as exc:
+                print(f"Nạp lại MB52 lỗi, giữ snapshot cũ: {exc}", file=sys.stderr, flush=True)
+
+    def snapshot_info(self) -> Dict[str, Any]:
+        snapshot = self.snapshot
+        return {
+            "source": snapshot["meta"].get("source", ""),
+            "sha256": snapshot["meta"]["sha256"],
+            "rows": snapshot["rows"],
+            "materials": snapshot["materials"],
+            "changed_materials": snapshot["changed_materials"],
+            "loaded_at": snapshot["loaded_at"],
+        }
+
+
+def parse_issue_lines(body: bytes) -> list[Dict[str, Any]]:
+    payload = json.loads(body)
+    if isinstance(payload, dict):
+        payload = payload.get("lines", [payload])
+    if not isinstance(payload, list) or not all(isinstance(line, dict) for line in payload):
+        raise StockCheckError("JSON cần là một dòng, danh sách dòng hoặc {\"lines\": [...]}.")
+    return payload
+
+
+def check_payload(snapshot: Dict[str, Any], body: bytes, content_type: str) -> Dict[str, Any]:
+    if "json" in content_type:
+        lines = check_issue_records(parse_issue_lines(body), snapshot["stock_index"], snapshot["stock_lookup"])
+    else:
+        final_report = check_issue(load_issue(body), None, snapshot["stock_index"])
+        lines = json.loads(final_report.to_json(orient="records", force_ascii=False))
+    ok = sum(1 for line in lines if line[COL_OK])
+    return {
+        "mb52_sha256": snapshot["meta"]["sha256"],
+        "summary": {"total": len(lines), "ok": ok, "not_ok": len(lines) - ok},
+        "lines": lines,
+    }
+
+
+class StockRequestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 giu ket noi giua cac truy van, tranh mat thoi gian bat tay TCP cho moi dong;
+    # tat Nagle de header va body khong bi giu lai cho ACK tre (~40ms moi truy van).
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server_version = f"StockFlow/{APP_VERSION}"
+
+    def send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> Optional[bytes]:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            self.send_json(413, {"error": f"Nội dung vượt quá {MAX_REQUEST_BYTES // (1024 * 1024)} MB."})
+            self.close_connection = True
+            return None
+        return self.rfile.read(length)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") in ("", "/health"):
+            self.send_json(200, {"status": "ok", "version": APP_VERSION, "mb52": self.server.service.snapshot_info()})
+        else:
+            self.send_json(404, {"error": f"Không có đường dẫn {self.path}"})
+
+    def do_POST(self) -> None:
+        body = self.read_body()
+        if body is None:
+            return
+        service = self.server.service
+        path = self.path.rstrip("/")
+        try:
+            if path == "/check":
+                started = time.perf_counter()
+                payload = check_payload(service.snapshot, body, self.headers.get("Content-Type", ""))
+                payload["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 3)
+                self.send_json(200, payload)
+            elif path == "/reload":
+                reloaded = service.reload(force=True)
+                self.send_json(200, {"reloaded": reloaded, "mb52": service.snapshot_info()})
+            else:
+                self.send_json(404, {"error": f"Không có đường dẫn {self.path}"})
+        except (StockCheckError, ValueError, OSError, zipfile.BadZipFile) as exc:
+            self.send_json(400, {"error": str(exc)})
+        except Exception as exc:
+            # Loi ngoai du kien (sheet/JSON le...) van phai tra loi, neu khong client keep-alive bi cat ket noi.
+            print(f"POST {self.path} lỗi:\n{traceback.format_exc()}", file=sys.stderr, flush=True)
+            self.send_json(500, {"error": f"{type(exc).__name__}: {exc}"})
+
+
+class StockServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: StockService):
+        super().__init__(address, StockRequestHandler)
+        self.service = service
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stockflow-server",
+        description="Dịch vụ HTTP kiểm tra phiếu xuất kho, giữ sẵn MB52 và chỉ mục tồn kho trong bộ nhớ.",
+    )
+    parser.add_argument(
+        "--mb52",
+        default=LOCAL_MB52_PATH,
+        help=f"File MB52 hoặc GitHub Raw URL (mặc định: {LOCAL_MB52_PATH})",
+    )
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Địa chỉ lắng nghe (mặc định: {DEFAULT_HOST})")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Cổng lắng nghe (mặc định: {DEFAULT_PORT})")
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=DEFAULT_RELOAD_INTERVAL,
+        help=f"Số giây giữa hai lần kiểm tra MB52 mới, 0 để tắt (mặc định: {DEFAULT_RELOAD_INTERVAL})",
+    )
+    parser.add_argument(
+        "--history-dir",
+        default=MB52_HISTORY_DIR,
+        help=f"Thư mục lưu lịch sử MB52 mỗi lần nạp (mặc định: {MB52_HISTORY_DIR})",
+    )
+    parser.add_argument("--no-history", action="store_true", help="Không lưu lịch sử MB52")
+    parser.add_argument("--version", action="version", version=f"%(prog)s {APP_VERSION}")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+
+    history = None
+    if not args.no_history:
+        try:
+            history = SnapshotStore(args.history_dir)
+        except (OSError, sqlite3.Error) as exc:
+            print(f"Không mở được lịch sử MB52, bỏ qua: {exc}", file=sys.stderr)
+    service = StockService(args.mb52, history)
+    try:
+        service.reload(force=True)
+    except (OSError, StockCheckError, ValueError) as exc:
+        print(f"MB52 lỗi: {exc}", file=sys.stderr)
+        return 2
+    info = service.snapshot_info()
+    print(f"MB52: {info['rows']:,} dòng · {info['materials']:,} mã vật tư · {info['source']}")
+
+    stop = threading.Event()
+    if args.reload_interval > 0:
+        threading.Thread(target=service.watch, args=(args.reload_interval, stop), daemon=True).start()
+
+    server = StockServer((args.host, args.port), service)
+    print(f"StockFlow server: http://{args.host}:{server.server_address[1]} (GET /health, POST /check, POST /reload)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
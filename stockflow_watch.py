@@ -0,0 +1,334 @@
+# =====================================================
+# STOCKFLOW WATCH - THEO DOI THU MUC, TU KIEM TRA LAI KHI CO MB52 / PHIEU MOI
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import zipfile
+from typing import Any, Dict, Optional, Tuple
+
+import pandas as pd
+
+try:
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+from stockflow_batch import data_file_kind, issue_result_path
+from stockflow_engine import (
+    APP_VERSION,
+    MB52_HISTORY_DIR,
+    StockCheckError,
+    build_stock_index,
+    build_transfer_plan,
+    check_issue,
+    export_excel,
+    load_issue,
+    load_mb52,
+    read_local_mb52,
+    refresh_stock_index,
+    summarize_report,
+    update_check_result,
+    write_file_atomic,
+)
+from stockflow_history import SnapshotStore
+
+
+DEFAULT_WATCH_FOLDER = "data"
+DEFAULT_WATCH_INTERVAL = 10
+DEFAULT_SETTLE_SECONDS = 5
+DEFAULT_WATCH_WORKERS = 2
+
+# (kich thuoc, mtime_ns): chi dung stat, khong doc noi dung file de biet file co doi hay khong.
+FileStat = Tuple[int, int]
+
+
+class FolderChangeSignal:
+    # watchdog chi can doi tuong co dispatch(event): moi su kien trong thu muc danh thuc vong quet.
+    def __init__(self, wake: threading.Event):
+        self.wake = wake
+
+    def dispatch(self, event: Any) -> None:
+        self.wake.set()
+
+
+class FolderWatcher:
+    def __init__(
+        self,
+        folder: str,
+        workers: int = DEFAULT_WATCH_WORKERS,
+        settle_seconds: float = DEFAULT_SETTLE_SECONDS,
+        history: Optional[SnapshotStore] = None,
+    ):
+        self.folder = folder
+        self.settle_seconds = settle_seconds
+        self.history = history
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stockflow-watch")
+        self.seen: Dict[str, FileStat] = {}
+        self.pending: Dict[str, Tuple[FileStat, float]] = {}
+        self.running: Dict[str, concurrent.futures.Future] = {}
+        # Phieu da kiem tra voi MB52 hien tai: path -> (issue_df, bao cao).
+        self.reports: Dict[str, Tuple[pd.DataFrame, pd.DataFrame]] = {}
+        # Phieu den truoc MB52 dau tien, kiem tra ngay khi co MB52.
+        self.deferred: set[str] = set()
+        # Phieu kiem tra loi (bao cao cu da bo): lan doi MB52 sau kiem tra lai toan bo.
+        self.recheck: set[str] = set()
+        self.stock: Optional[Dict[str, Any]] = None
+        self.lock = threading.Lock()
+
+    def scan(self) -> list[str]:
+        # File chi duoc xu ly khi (kich thuoc, mtime) dung yen qua settle_seconds: tranh doc file dang ghi do.
+        now = time.monotonic()
+        current: Dict[str, FileStat] = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and data_file_kind(entry.name):
+                    stat = entry.stat()
+                    current[entry.path] = (stat.st_size, stat.st_mtime_ns)
+
+        ready = []
+        for path, stat in current.items():
+            if self.seen.get(path) == stat:
+                self.pending.pop(path, None)
+                continue
+            waiting = self.pending.get(path)
+            if waiting is None or waiting[0] != stat:
+                self.pending[path] = (stat, now)
+            elif now - waiting[1] >= self.settle_seconds:
+                del self.pending[path]
+                self.seen[path] = stat
+                ready.append(path)
+        for path in [path for path in list(self.pending) + list(self.seen) if path not in current]:
+            self.pending.pop(path, None)
+            self.seen.pop(path, None)
+            self.deferred.discard(path)
+            with self.lock:
+                self.reports.pop(path, None)
+                self.recheck.discard(path)
+        return ready
+
+    def poll(self) -> None:
+        self.running = {path: future for path, future in self.running.items() if not future.done()}
+        ready = self.scan()
+        mb52_paths = [path for path in ready if data_file_kind(path) == "mb52"]
+        if mb52_paths:
+            self.reload_mb52(max(mb52_paths, key=lambda path: self.seen[path][1]))
+        for path in ready:
+            if path in mb52_paths:
+                continue
+            if self.stock is None:
+                self.deferred.add(path)
+            elif path in self.running:
+                # Ban cu cua file dang duoc kiem tra: quan sat lai o lan quet sau roi moi kiem tra ban moi.
+                self.seen.pop(path, None)
+            else:
+                self.submit(path)
+
+    def submit(self, path: str, changed: Optional[pd.Index] = None) -> None:
+        stock = self.stock
+        self.running[path] = self.pool.submit(self.check_file, path, stock, changed)
+
+    def reload_mb52(self, path: str) -> None:
+        try:
+            file_bytes, meta = read_local_mb52(path)
+            if self.stock is not None and meta["sha256"] == self.stock["meta"]["sha256"]:
+                return
+            mb52_raw = load_mb52(file_bytes, meta)
+        except (OSError, StockCheckError, ValueError, zipfile.BadZipFile) as exc:
+            # Giu danh dau da thay: file loi chi duoc doc lai khi kich thuoc/mtime doi, khong doc lai lien tuc.
+            print(f"MB52 {path}: lỗi {exc}", file=sys.stderr, flush=True)
+            return
+        if self.history is not None:
+            try:
+                # Nguon lich su la ca thu muc theo doi: MB52 moi co the den voi ten file khac.
+                self.history.record(mb52_raw, {**meta, "url": self.folder})
+            except (OSError, ImportError, ValueError, sqlite3.Error) as exc:
+                print(f"Không lưu được lịch sử MB52: {exc}", file=sys.stderr, flush=True)
+
+        # Cho cac phieu dang kiem tra voi MB52 cu xong truoc, de moi bao cao trong bo nho cung mot snapshot.
+        concurrent.futures.wait(list(self.running.values()))
+        self.running.clear()
+        changed = None
+        if self.stock is None:
+            stock_index = build_stock_index(mb52_raw)
+        else:
+            stock_index, changed = refresh_stock_index(self.stock["stock_index"], mb52_raw)
+        self.stock = {"meta": meta, "stock_index": stock_index}
+        print(
+            f"MB52 {os.path.basename(path)}: {len(mb52_raw):,} dòng"
+            + (f" · {len(changed):,} mã vật tư thay đổi" if changed is not None else ""),
+            flush=True,
+        )
+        with self.lock:
+            checked = sorted(set(self.reports) | self.recheck)
+            self.recheck.clear()
+        for issue_path in checked:
+            self.submit(issue_path, changed)
+        for issue_path in sorted(self.deferred):
+            self.submit(issue_path)
+        self.deferred.clear()
+
+    def check_file(self, path: str, stock: Dict[str, Any], changed: Optional[pd.Index]) -> None:
+        label = os.path.basename(path)
+        try:
+            with self.lock:
+                previous = self.reports.get(path)
+            if changed is not None and previous is not None:
+                # MB52 doi: chi tinh lai cac dong co Material thay doi; khong dong nao bi anh huong thi giu file cu.
+                issue_df, previous_report = previous
+                final_report = update_check_result(previous_report, issue_df, stock["stock_index"], changed)
+                if final_report is previous_report:
+                    return
+            else:
+                with open(path, "rb") as file:
+                    issue_df = load_issue(file.read())
+                final_report = check_issue(issue_df, None, stock["stock_index"])
+
+            transfer_plan = build_transfer_plan(final_report, stock["stock_index"])
+            data = export_excel(final_report, issue_df, stock["meta"], transfer_plan)
+            output_path = issue_result_path((path, path, None), None)
+
+            def write_result(temp_path: str) -> None:
+                with open(temp_path, "wb") as file:
+                    file.write(data)
+
+            write_file_atomic(output_path, write_result)
+            with self.lock:
+                self.reports[path] = (issue_df, final_report)
+                self.recheck.discard(path)
+        except (OSError, StockCheckError, ValueError, zipfile.BadZipFile) as exc:
+            print(f"{label}: lỗi {exc}", file=sys.stderr, flush=True)
+            self.drop_report(path)
+            return
+        except Exception:
+            # Loi ngoai du kien cung phai hien ra; xu ly ngay trong worker (khong dung done-callback) vi
+            # reload_mb52 chi cho future xong, callback co the chay sau khi no da doc self.reports.
+            print(f"{label}: lỗi không mong đợi\n{traceback.format_exc()}", file=sys.stderr, flush=True)
+            self.drop_report(path)
+            return
+
+        summary = summarize_report(final_report)
+        print(
+            f"{datetime.datetime.now():%H:%M:%S} {label}: {summary['total']:,} dòng · đã xuất đủ {summary['ok']:,} · "
+            f"chưa đảm bảo {summary['not_ok']:,} -> {os.path.basename(output_path)}",
+            flush=True,
+        )
+
+    def drop_report(self, path: str) -> None:
+        # Bao cao trong bo nho van la cua MB52 cu: khong duoc dung lam goc cap nhat tung phan nua.
+        with self.lock:
+            self.reports.pop(path, None)
+            self.recheck.add(path)
+
+    def busy(self) -> bool:
+        return bool(self.pending) or any(not future.done() for future in self.running.values())
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stockflow-watch",
+        description="Theo dõi thư mục, tự kiểm tra lại phiếu xuất kho khi có MB52 hoặc phiếu mới/thay đổi.",
+    )
+    parser.add_argument(
+        "folder",
+        nargs="?",
+        default=DEFAULT_WATCH_FOLDER,
+        help=f"Thư mục chứa MB52*.xlsx và file phiếu (mặc định: {DEFAULT_WATCH_FOLDER})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WATCH_WORKERS,
+        help=f"Số phiếu kiểm tra song song (mặc định: {DEFAULT_WATCH_WORKERS})",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=DEFAULT_SETTLE_SECONDS,
+        help=f"Số giây file phải đứng yên trước khi đọc (mặc định: {DEFAULT_SETTLE_SECONDS})",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_WATCH_INTERVAL,
+        help=f"Số giây giữa hai lần quét khi không có watchdog (mặc định: {DEFAULT_WATCH_INTERVAL})",
+    )
+    parser.add_argument(
+        "--history-dir",
+        default=MB52_HISTORY_DIR,
+        help=f"Thư mục lưu lịch sử MB52 (mặc định: {MB52_HISTORY_DIR})",
+    )
+    parser.add_argument("--no-history", action="store_true", help="Không lưu lịch sử MB52")
+    parser.add_argument("--once", action="store_true", help="Kiểm tra các file hiện có rồi thoát")
+    parser.add_argument("--version", action="version", version=f"%(prog)s {APP_VERSION}")
+    return parser
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if not os.path.isdir(args.folder):
+        print(f"Không có thư mục {args.folder}", file=sys.stderr)
+        return 2
+
+    history = None
+    if not args.no_history:
+        try:
+            history = SnapshotStore(args.history_dir)
+        except (OSError, sqlite3.Error) as exc:
+            print(f"Không mở được lịch sử MB52, bỏ qua: {exc}", file=sys.stderr)
+
+    watcher = FolderWatcher(args.folder, max(1, args.workers), max(0.0, args.settle), history)
+    wake = threading.Event()
+    observer = None
+    if Observer is not None and not args.once:
+        observer = Observer()
+        observer.schedule(FolderChangeSignal(wake), args.folder, recursive=False)
+        observer.start()
+    elif not args.once:
+        print("Chưa cài watchdog (pip install watchdog): chuyển sang quét stat định kỳ.", file=sys.stderr, flush=True)
+    print(
+        f"Đang theo dõi {os.path.abspath(args.folder)} "
+        f"({'sự kiện hệ thống file' if observer else f'quét stat mỗi {args.interval:g}s'}, "
+        f"{max(1, args.workers)} worker). Ctrl+C để dừng.",
+        flush=True,
+    )
+
+    try:
+        while True:
+            watcher.poll()
+            if args.once and not watcher.busy():
+                break
+            # Co file dang cho dung yen thi hen quet lai sau settle; con lai ngu den khi co su kien (hoac het interval).
+            if watcher.pending or args.once:
+                timeout: Optional[float] = min(args.settle, args.interval) if args.once else args.settle
+            else:
+                timeout = None if observer else args.interval
+            wake.wait(timeout)
+            wake.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        watcher.close()
+    if watcher.deferred:
+        print(f"Chưa có MB52 trong thư mục, {len(watcher.deferred)} phiếu chưa được kiểm tra.", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# =====================================================
+# TEST CACHE HTTP MB52 (ETag / Last-Modified) VOI MAY CHU HTTP GIA LAP
+# Author: DatND5
+# Version: 3.0
+# =====================================================
+
+import http.server
+import os
+import threading
+
+import pytest
+
+import stockflow_engine as engine
+
+
+MB52_BODY = b"MB52-" + bytes(range(256)) * 64
+ETAG = '"mb52-v1"'
+LAST_MODIFIED = "Wed, 14 Oct 2026 08:00:00 GMT"
+
+
+class FakeGitHubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeGitHubHandler)
+        self.requests = []
+        self.connections = 0
+        self.body_bytes = 0
+        # Ep tra 304 bat ke header (gia lap proxy/CDN tra loi sai).
+        self.force_304 = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/MB52.XLSX"
+
+
+class FakeGitHubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.server.force_304:
+            self.server.force_304 -= 1
+            not_modified = True
+        else:
+            not_modified = (
+                self.headers.get("If-None-Match") == ETAG
+                or self.headers.get("If-Modified-Since") == LAST_MODIFIED
+            )
+        if not_modified:
+            self.send_response(304)
+            self.send_header("ETag", ETAG)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("Content-Length", str(len(MB52_BODY)))
+        self.end_headers()
+        self.wfile.write(MB52_BODY)
+        self.server.body_bytes += len(MB52_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "HTTP_CACHE_DIR", str(tmp_path / "http"))
+    engine.get_http_session.cache_clear()
+    httpd = FakeGitHubServer()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    engine.get_http_session().close()
+    engine.get_http_session.cache_clear()
+
+
+def test_first_fetch_stores_validators(server):
+    content, meta = engine.download_mb52_from_github(server.url)
+
+    assert content == MB52_BODY
+    assert meta["http_status"] == "200"
+    assert meta["etag"] == ETAG
+    assert meta["last_modified"] == LAST_MODIFIED
+    assert "If-None-Match" not in server.requests[0]
+    body, validators = engine.read_http_cache(server.url)
+    assert body == MB52_BODY
+    assert validators["etag"] == ETAG
+    assert validators["last_modified"] == LAST_MODIFIED
+
+
+def test_second_fetch_is_conditional_and_served_from_cache(server):
+    first, _ = engine.download_mb52_from_github(server.url)
+    second, meta = engine.download_mb52_from_github(server.url)
+
+    assert len(server.requests) == 2
+    assert server.requests[1]["If-None-Match"] == ETAG
+    assert server.requests[1]["If-Modified-Since"] == LAST_MODIFIED
+    assert meta["http_status"] == "304"
+    # Body chi di qua mang mot lan; lan 2 lay tu cache tren dia.
+    assert server.body_bytes == len(MB52_BODY)
+    assert second == first == MB52_BODY
+    assert meta["sha256"] == engine.content_digest(MB52_BODY)
+
+
+def test_session_is_reused(server):
+    for _ in range(3):
+        engine.download_mb52_from_github(server.url)
+
+    assert len(server.requests) == 3
+    assert server.connections == 1
+
+
+@pytest.mark.parametrize("damage", ["missing", "corrupt"])
+def test_304_without_cached_body_refetches(server, damage):
+    engine.download_mb52_from_github(server.url)
+    body_path = engine.http_cache_path(server.url, ".body")
+    if damage == "missing":
+        os.remove(body_path)
+    else:
+        with open(body_path, "wb") as file:
+            file.write(b"hong")
+    server.force_304 = 1
+
+    content, meta = engine.download_mb52_from_github(server.url)
+
+    assert content == MB52_BODY
+    assert meta["http_status"] == "200"
+    assert len(server.requests) == 3
+    assert "If-None-Match" not in server.requests[2]
+    assert "If-Modified-Since" not in server.requests[2]
+    assert engine.read_http_cache(server.url)[0] == MB52_BODY